@@ -0,0 +1,340 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+An asyncio based network device class. Drives many switches from a single
+event loop instead of one thread and one netmiko session per switch
+"""
+
+import asyncio
+import os
+
+import asyncssh
+
+from netdevices import (FACT_COMMANDS, InvalidConfigCommand, Switch,
+                        boot_path, copy_state, file_size, md5_from_output,
+                        reload_command, split_output)
+from parsers import parse
+from tracing import timed
+
+# Errors raised when a switch cannot be reached or logged in to
+CONNECT_ERRORS = (OSError, asyncio.TimeoutError, asyncssh.Error)
+
+
+class AsyncSwitch(Switch):
+    """A Switch whose remote operations are coroutines. Await gather() to
+    collect the facts check_upgrade needs. The accessors that only derive
+    from those facts (running_image, file_on_flash, free_space, family and
+    so on) are inherited from Switch and read from the cache"""
+
+    def __init__(self,
+                 host,
+                 username,
+                 password,
+                 type="cisco_ios",
+                 debug_on=False,
+                 timeout=30,
+                 keepalive=30,
+                 backups=None,
+                 tracer=None,
+                 port=22):
+        super().__init__(host,
+                         username,
+                         password,
+                         type,
+                         debug_on,
+                         backups=backups,
+                         tracer=tracer,
+                         port=port)
+        self.timeout = timeout
+        self.keepalive = keepalive
+
+    async def ssh(self):
+        """Establishes an SSH connection"""
+        self.log.debug("Executing [ssh]")
+        if self.connect is None or self.connect.is_closed():
+            with self.span("connect", "command"):
+                self.connect = await asyncio.wait_for(
+                    asyncssh.connect(
+                        self.host,
+                        port=self.port,
+                        username=self.username,
+                        password=self.password,
+                        known_hosts=None,
+                        keepalive_interval=self.keepalive,
+                    ),
+                    self.timeout,
+                )
+        self.log.debug("[ssh] complete")
+        return self.connect
+
+    async def close(self):
+        """Closes the SSH connection"""
+        if self.connect is not None:
+            self.connect.close()
+            await self.connect.wait_closed()
+            self.connect = None
+        self.log.flush()
+        return True
+
+    def drop_session(self):
+        """Closes a connection that a failure may have broken, so the next
+        command opens a new one"""
+        if self.connect is not None:
+            self.connect.close()
+            self.connect = None
+        return True
+
+    async def shell(self, commands, timeout=None):
+        """Runs a list of commands in an interactive shell and returns the raw
+        session output. The shell is closed with exit once all commands have
+        been sent"""
+        self.log.debug("Executing [shell]")
+        connect = await self.ssh()
+        process = await connect.create_process(term_type="vt100")
+        process.stdin.write("terminal length 0\n")
+        for command in commands:
+            process.stdin.write(f"{command}\n")
+        process.stdin.write("exit\n")
+        with self.span("; ".join(commands), "command"):
+            output = await asyncio.wait_for(process.stdout.read(), timeout
+                                            or self.timeout)
+        process.close()
+        self.log.debug("[shell] complete")
+        return output
+
+    async def send_command(self, command, use_textfsm=False, timeout=None):
+        """Runs a single exec command, optionally parsed"""
+        output = split_output(await self.shell([command], timeout),
+                              [command]).get(command, "")
+        if use_textfsm:
+            return parse(output, self.type, command)
+        return output
+
+    @timed
+    async def facts(self):
+        """Gathers basic facts by running show version on the switch"""
+        self.log.debug("Executing [base_facts]")
+        self.allfacts.update((await self.send_command("show ver",
+                                                      use_textfsm=True))[0])
+        self.log.debug("[base_facts] complete")
+        return self.allfacts
+
+    @timed
+    async def next_boot_file(self):
+        """returns the bootfile configuration from running config in a
+        standard format"""
+        self.log.debug("Executing [next_boot_file]")
+        if not self.allfacts.get("nbf"):
+            self.allfacts["nbf"] = boot_path(await self.send_command(
+                "show boot | i BOOT path-list"))
+        self.log.debug("[next_boot_file] complete")
+        return self.allfacts["nbf"]
+
+    @timed
+    async def flash(self):
+        """Gets the current flash information"""
+        self.log.debug("Executing [flash]")
+        self.flashinfo = await self.send_command("dir", use_textfsm=True)
+        for item in self.flashinfo[:]:
+            if "d" in item["permissions"]:
+                self.flashinfo.extend(await self.send_command(
+                    f"dir {item['name']}", use_textfsm=True))
+        self.log.debug("[flash] complete")
+        return self.flashinfo
+
+    @timed
+    async def gather(self):
+        """Collects every fact used by check_upgrade in a single shell
+        session"""
+        self.log.debug("Executing [gather]")
+        self.load_facts(split_output(await self.shell(FACT_COMMANDS),
+                                     FACT_COMMANDS))
+        self.log.debug("[gather] complete")
+        return self.allfacts
+
+    @timed
+    def reload_pending(self):
+        """Checks if a reload is pending on the switch. Requires gather()"""
+        self.log.debug("Executing [reload_pending]")
+        pending = self.running_image() != self.allfacts["nbf"]
+        self.log.debug("[reload_pending] complete")
+        return pending
+
+    @timed
+    async def save_config(self):
+        """Saves the current running config"""
+        self.log.debug("Executing [save_config]")
+        await self.shell(["wr mem"])
+        self.log.debug("[save_config] complete")
+        return True
+
+    @timed
+    async def backup_config(self, path="../backups/", phase=None):
+        """Takes a copy of the current running config, see
+        Switch.backup_config"""
+        self.log.debug("Executing [backup_config]")
+        self.save_backup(await self.send_command("show run"), path, phase)
+        self.log.debug("[backup_config] complete")
+        return True
+
+    @timed
+    async def remote_size(self, path):
+        """Returns the size of a file on flash in bytes, or None"""
+        return file_size(await self.send_command(f"dir {path}",
+                                                 use_textfsm=True))
+
+    @timed
+    async def remote_md5(self, path):
+        """Returns the MD5 hash of a file on flash"""
+        return md5_from_output(await self.send_command(
+            f"verify /md5 {path}", timeout=600))
+
+    @timed
+    async def delete_file(self, path):
+        """Deletes a file from flash"""
+        await self.shell([f"delete /force {path}"])
+        return True
+
+    @timed
+    async def file_landed(self, file, destination, md5=None):
+        """Checks if a complete copy of file is already at destination"""
+        if await self.remote_size(destination) != os.path.getsize(file):
+            return False
+        return md5 is None or await self.remote_md5(destination) == md5
+
+    @timed
+    async def send_file(self,
+                        file,
+                        destination,
+                        progress=None,
+                        retries=0,
+                        md5=None,
+                        checkpoint=None):
+        """Transfers a given file to switch flash memory. progress is an
+        asyncssh progress handler. Behaves like Switch.send_file"""
+        self.log.debug("Executing [send_file]")
+        if await self.file_landed(file, destination, md5):
+            self.log.info("File already on flash, skipping transfer")
+            if checkpoint is not None:
+                checkpoint.record(self.host, file, os.path.getsize(file),
+                                  "complete")
+            return True
+        for attempt in range(retries + 1):
+            sent = [0]
+
+            def track(srcpath, dstpath, copied, total):
+                sent[0] = copied
+                if progress:
+                    progress(srcpath, dstpath, copied, total)
+
+            try:
+                connect = await self.ssh()
+                with self.span("scp", "transfer") as span:
+                    span["bytes"] = os.path.getsize(file)
+                    await asyncssh.scp(file, (connect, destination),
+                                       progress_handler=track)
+                if checkpoint is not None:
+                    checkpoint.record(self.host, file, sent[0], "complete")
+                self.log.debug("[send_file] complete")
+                return True
+            except CONNECT_ERRORS as e:
+                self.log.error(f"Transfer dropped at {sent[0]} bytes", str(e))
+                if checkpoint is not None:
+                    checkpoint.record(self.host, file, sent[0], "failed")
+                if attempt < retries:
+                    await asyncio.sleep(2**attempt)
+                # The partial file goes after the last attempt too, so a
+                # failed transfer never leaves it filling flash
+                await self.remove_partial(destination)
+        self.log.debug("[send_file] complete")
+        return False
+
+    async def remove_partial(self, destination):
+        """Removes the partial file of a failed transfer over a new session,
+        see Switch.remove_partial"""
+        self.drop_session()
+        try:
+            await self.delete_file(destination)
+        except CONNECT_ERRORS as e:
+            self.log.error(f"Could not remove {destination}", str(e))
+            self.drop_session()
+            return False
+        return True
+
+    @timed
+    async def pull_file(self,
+                        url,
+                        destination,
+                        progress=None,
+                        timeout=3600,
+                        poll=5,
+                        retries=0):
+        """Has the switch copy a file from url to flash itself, then waits on
+        the session until the copy finishes. Behaves like Switch.pull_file"""
+        self.log.debug("Executing [pull_file]")
+        for attempt in range(retries + 1):
+            try:
+                if await self._pull(url, destination, progress, timeout,
+                                    poll):
+                    self.log.debug("[pull_file] complete")
+                    return True
+                self.log.error("Copy from image server failed")
+            except CONNECT_ERRORS as e:
+                self.log.error("Copy from image server dropped", str(e))
+            if attempt < retries:
+                await asyncio.sleep(2**attempt)
+            await self.remove_partial(destination)
+        self.log.debug("[pull_file] complete")
+        return False
+
+    async def _pull(self, url, destination, progress, timeout, poll):
+        """Runs one copy from url, answering its prompts. Returns True if it
+        finished"""
+        connect = await self.ssh()
+        process = await connect.create_process(term_type="vt100")
+        process.stdin.write(f"copy {url} {destination}\n")
+        output = ""
+        answered = 0
+        deadline = asyncio.get_running_loop().time() + timeout
+        try:
+            while asyncio.get_running_loop().time() < deadline:
+                try:
+                    chunk = await asyncio.wait_for(process.stdout.read(4096),
+                                                   poll)
+                    if not chunk:
+                        break
+                    output += chunk
+                except asyncio.TimeoutError:
+                    pass
+                if progress:
+                    progress()
+                state = copy_state(output, answered)
+                if state == "prompt":
+                    process.stdin.write("\n")
+                    answered = len(output)
+                elif state:
+                    break
+        finally:
+            process.close()
+        return copy_state(output) == "done"
+
+    @timed
+    async def send_config(self, command):
+        """Sends the given configuration command string to the switch"""
+        self.log.debug("Executing [send_config]")
+        if isinstance(command, str):
+            command = [command]
+        output = await self.shell(["configure terminal", *command, "end"])
+        if "% Invalid input" in output:
+            raise InvalidConfigCommand(command)
+        self.log.debug("[send_config] complete")
+        return True
+
+    @timed
+    async def reload(self, minutes=5):
+        """Reload the switch, see Switch.reload"""
+        self.log.debug("Executing [reload]")
+        await self.shell([reload_command(minutes), "y"])
+        self.log.debug("[reload] complete")
+        return True
@@ -0,0 +1,148 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A content addressed store for switch config backups. Identical configs are
+kept once, compressed, and every backup is indexed by host and time
+"""
+
+import argparse
+import datetime as dt
+import difflib
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# Lines of show run that change without the config changing
+_volatile = re.compile(r"^(Building configuration|Current configuration :|"
+                       r"! Last configuration change|! NVRAM config last|"
+                       r"ntp clock-period)")
+
+
+def _normalise(config):
+    """Removes the volatile lines from a config so that identical configs
+    hash the same"""
+    return "\n".join(line for line in config.splitlines()
+                     if not _volatile.match(line)).strip("\n") + "\n"
+
+
+class BackupStore:
+    """Stores configs under objects/ by SHA-256 and records every backup in
+    index.jsonl as host, time, phase and hash. The index is only read into
+    memory once a history is asked for"""
+
+    def __init__(self, path="../backups/"):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        self.index_file = os.path.join(path, "index.jsonl")
+        self.lock = threading.Lock()
+        self.index = None
+
+    def _object(self, digest):
+        return os.path.join(self.objects, digest[:2], f"{digest}.gz")
+
+    def _load(self):
+        """Reads the index into memory, grouped by host. Must be called with
+        the lock held"""
+        if self.index is not None:
+            return self.index
+        self.index = {}
+        try:
+            with open(self.index_file) as index:
+                for line in index:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.index.setdefault(entry["host"], []).append(entry)
+        except FileNotFoundError:
+            pass
+        return self.index
+
+    def store(self, host, config, phase=None):
+        """Saves a config for host. The config is only written if this exact
+        config has not been stored before. Returns its hash"""
+        data = _normalise(config).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        target = self._object(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temp = f"{target}.{threading.get_ident()}.tmp"
+            with gzip.open(temp, "wb") as backup:
+                backup.write(data)
+            os.replace(temp, target)
+        entry = {
+            "host": host,
+            "time": time.time(),
+            "phase": phase,
+            "hash": digest,
+        }
+        with self.lock:
+            # The index is only read for history, so a backup is one append
+            # however long the history is
+            if self.index is not None:
+                self.index.setdefault(host, []).append(entry)
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.index_file, "a") as index:
+                index.write(json.dumps(entry) + "\n")
+        return digest
+
+    def history(self, host):
+        """Returns every backup of host, oldest first"""
+        with self.lock:
+            return list(self._load().get(host, []))
+
+    def get(self, digest):
+        """Returns the config with the given hash"""
+        with gzip.open(self._object(digest), "rb") as backup:
+            return backup.read().decode("utf-8")
+
+    def diff(self, host, old=-2, new=-1):
+        """Returns a unified diff between two backups of host, by position in
+        its history. Defaults to the last two"""
+        history = self.history(host)
+        if len(history) < 2:
+            return ""
+        before, after = history[old], history[new]
+        return "".join(
+            difflib.unified_diff(
+                self.get(before["hash"]).splitlines(keepends=True),
+                self.get(after["hash"]).splitlines(keepends=True),
+                fromfile=_label(before),
+                tofile=_label(after),
+            ))
+
+
+def _label(entry):
+    timestamp = dt.datetime.fromtimestamp(
+        entry["time"]).strftime("%d%m%Y-%H%M%S")
+    return f"{entry['host']}-{timestamp}"
+
+
+def main():
+    """List, show or diff the backups of a switch"""
+    parser = argparse.ArgumentParser(description="switch config backups")
+    parser.add_argument("host", help="switch IP address")
+    parser.add_argument("--show",
+                        help="Print the backup at this position, -1 is the "
+                        "latest",
+                        type=int)
+    parser.add_argument("--diff",
+                        help="Diff the last two backups",
+                        action="store_true")
+    args = parser.parse_args()
+    store = BackupStore()
+    if args.diff:
+        print(store.diff(args.host))
+    elif args.show is not None:
+        print(store.get(store.history(args.host)[args.show]["hash"]))
+    else:
+        for position, entry in enumerate(store.history(args.host)):
+            print(position, _label(entry), entry["phase"] or "",
+                  entry["hash"][:12])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Times every phase of swupgrade.py against a simulated fleet, at several
+fleet sizes, and flags phases that have got slower per switch since a
+baseline run
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import logger
+import swupgrade
+from backupstore import BackupStore
+from catalog import Catalog
+from connections import ConnectionPool
+from imageserver import ImageServer
+from logger import Logger
+from reloads import ReloadScheduler
+from simfleet import SimFleet, image_version
+from swupgrade import global_arrays
+from transfers import TransferScheduler
+
+FAMILY = "C2960X"
+FEATURESET = "universal"
+TARGET = "c2960x-universalk9-mz.152-7.E2.bin"
+
+
+def parse_arguments():
+    """Manage arguments and help file"""
+    parser = argparse.ArgumentParser(
+        description="swupgrade benchmark against a simulated fleet")
+    parser.add_argument("--sizes",
+                        help="Comma separated fleet sizes to run",
+                        default="10,1000,10000")
+    parser.add_argument("--engine",
+                        help="Connection engine to benchmark",
+                        choices=["netmiko", "async"],
+                        default="netmiko")
+    parser.add_argument("--workers",
+                        help="Number of switches to work on in parallel",
+                        type=int,
+                        default=20)
+    parser.add_argument("--batch",
+                        help="Collect switch facts in a single command burst",
+                        action="store_true")
+    parser.add_argument("--serve",
+                        help="Have switches pull the image over HTTP",
+                        action="store_true")
+    parser.add_argument("--image-size",
+                        help="Size of the upgrade image in bytes",
+                        type=int,
+                        default=1024 * 1024)
+    parser.add_argument("--latency",
+                        help="Seconds each switch takes to answer",
+                        type=float,
+                        default=0.0)
+    parser.add_argument("--jitter",
+                        help="Random extra seconds added to the latency",
+                        type=float,
+                        default=0.0)
+    parser.add_argument("--failure-rate",
+                        help="Chance a login is dropped",
+                        type=float,
+                        default=0.0)
+    parser.add_argument("--transfer-failure-rate",
+                        help="Chance a file transfer drops half way",
+                        type=float,
+                        default=0.0)
+    parser.add_argument("--retries",
+                        help="Times to retry a dropped file transfer",
+                        type=int,
+                        default=2)
+    parser.add_argument("--reload-wave",
+                        help="Reload in waves of this size and wait for each "
+                        "wave to come back",
+                        type=int,
+                        default=0)
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline",
+                        help="Results file of an earlier run to compare with")
+    parser.add_argument("--tolerance",
+                        help="Slowdown per switch allowed before a phase "
+                        "counts as a regression",
+                        type=float,
+                        default=0.25)
+    parser.add_argument("--verbose",
+                        help="Show the output of every phase",
+                        action="store_true")
+    return parser.parse_args()
+
+
+def make_image(directory, size):
+    """Writes a test upgrade image and returns its swimages.yml entry"""
+    os.makedirs(directory, exist_ok=True)
+    md5 = hashlib.md5()
+    with open(os.path.join(directory, TARGET), "wb") as image:
+        while size > 0:
+            chunk = os.urandom(min(size, 1024 * 1024))
+            md5.update(chunk)
+            image.write(chunk)
+            size -= len(chunk)
+    return {
+        FAMILY: {
+            FEATURESET: {
+                "image": TARGET,
+                "MD5": md5.hexdigest(),
+                "version": image_version(TARGET),
+            }
+        }
+    }
+
+
+def reset():
+    """Empties the lists shared by the swupgrade phases"""
+    global_arrays.clear()
+
+
+def run_netmiko(args, fleet, images, image_path, scheduler, reloader,
+                options, log):
+    """Runs every phase on the netmiko engine. Yields each phase name once
+    it has finished"""
+    pool = ConnectionPool(max_sessions=args.workers)
+    try:
+        swupgrade.audit_hosts(fleet.username,
+                              fleet.password,
+                              images,
+                              args.workers,
+                              collect=args.batch,
+                              image_path=image_path,
+                              pool=pool,
+                              **options)
+        yield "check_upgrade"
+        swupgrade.copy_file(log, scheduler)
+        yield "copy_file"
+        swupgrade.verify_files(log, args.workers)
+        yield "verify_files"
+        swupgrade.upgrade_switches(log)
+        yield "upgrade_switches"
+        swupgrade.reload_switches(log, reloader, delay=0)
+        yield "reload_switches"
+    finally:
+        pool.close_all()
+
+
+async def run_async(args, fleet, images, image_path, scheduler, reloader,
+                    options, log, timings):
+    """Runs every phase on the async engine, recording the seconds each
+    took in timings"""
+    phases = {
+        "check_upgrade":
+        lambda: swupgrade.audit_hosts_async(fleet.username,
+                                            fleet.password,
+                                            images,
+                                            args.workers,
+                                            image_path=image_path,
+                                            **options),
+        "copy_file":
+        lambda: swupgrade.copy_file_async(log, args.workers, scheduler),
+        "verify_files":
+        lambda: swupgrade.verify_files_async(log, args.workers),
+        "upgrade_switches":
+        lambda: swupgrade.upgrade_switches_async(log, args.workers),
+        "reload_switches":
+        lambda: swupgrade.reload_switches_async(
+            log, args.workers, reloader, delay=0),
+    }
+    for phase, run in phases.items():
+        start = time.perf_counter()
+        await run()
+        timings[phase] = time.perf_counter() - start
+
+
+def run_size(args, size):
+    """Builds a fleet of size switches, runs every phase against it and
+    returns the results"""
+    reset()
+    log = Logger("[BENCHMARK]")
+    with tempfile.TemporaryDirectory() as workdir, SimFleet(
+            latency=args.latency,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            transfer_failure_rate=args.transfer_failure_rate,
+            time_scale=0) as fleet:
+        image_path = os.path.join(workdir, "images", "")
+        images = Catalog(make_image(image_path, args.image_size))
+        global_arrays.host_list.extend(fleet.populate(size))
+        scheduler = TransferScheduler(log, args.workers, retries=args.retries)
+        if args.serve:
+            scheduler.server = ImageServer("127.0.0.1", 0,
+                                           image_path).start()
+        reloader = None
+        if args.reload_wave:
+            reloader = ReloadScheduler(log,
+                                       args.reload_wave,
+                                       delay=0,
+                                       interval=1,
+                                       timeout=60)
+        options = {
+            "backups": BackupStore(os.path.join(workdir, "backups", "")),
+            "port": fleet.port,
+        }
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        timings = {}
+        error = None
+        try:
+            with contextlib.redirect_stdout(output):
+                if args.engine == "async":
+                    asyncio.run(
+                        run_async(args, fleet, images, image_path, scheduler,
+                                  reloader, options, log, timings))
+                else:
+                    start = time.perf_counter()
+                    for phase in run_netmiko(args, fleet, images, image_path,
+                                             scheduler, reloader, options,
+                                             log):
+                        timings[phase] = time.perf_counter() - start
+                        start = time.perf_counter()
+        # Recorded so the other sizes still run, and fails the benchmark
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            # Lines still queued for the writer must land before it closes
+            logger.flush()
+            if output is not sys.stdout:
+                output.close()
+            if scheduler.server:
+                scheduler.server.stop()
+        upgraded = sum(switch.boot == f"/{TARGET}"
+                       for switch in fleet.switches.values())
+    return {
+        "engine": args.engine,
+        "size": size,
+        "workers": args.workers,
+        "timings": timings,
+        "error": error,
+        "copied": len(global_arrays.upgrade_list),
+        "reloaded": len(global_arrays.reload_list),
+        "upgraded": upgraded,
+    }
+
+
+def _key(result):
+    return f"{result['engine']}/{result['size']}"
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a line for every phase that takes longer per switch than in
+    the baseline, by more than tolerance"""
+    earlier = {_key(result): result for result in baseline}
+    slower = []
+    for result in results:
+        before = earlier.get(_key(result))
+        if before is None:
+            continue
+        for phase, seconds in result["timings"].items():
+            was = before["timings"].get(phase)
+            if was and seconds > was * (1 + tolerance):
+                slower.append(f"{_key(result)} {phase}: {was:.2f}s -> "
+                              f"{seconds:.2f}s")
+    return slower
+
+
+def report(results, log):
+    """Prints the time taken by every phase, and per switch"""
+    for result in results:
+        log.info(
+            f"{_key(result)} - {result['workers']} workers",
+            f"{result['copied']} copied, {result['reloaded']} reloaded, "
+            f"{result['upgraded']} booting the new image",
+        )
+        if result["error"]:
+            log.error(f"{_key(result)} stopped after "
+                      f"{len(result['timings'])} phases", result["error"])
+        for phase, seconds in result["timings"].items():
+            log.info(
+                f"{_key(result)} {phase}",
+                f"{seconds:.2f}s, {1000 * seconds / result['size']:.1f} "
+                f"ms/switch, {result['size'] / max(seconds, 0.001):.1f} "
+                f"switches/s",
+            )
+
+
+def main():
+    """Run the benchmark at every size and compare with a baseline"""
+    args = parse_arguments()
+    log = Logger("[BENCHMARK]")
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        log.info(f"Benchmarking {size} simulated switches...")
+        results.append(run_size(args, size))
+    report(results, log)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    slower = []
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            slower = regressions(results, json.load(baseline), args.tolerance)
+        for line in slower:
+            log.error("Regression", line)
+        if not slower:
+            log.success("No regressions against the baseline")
+    # A run stopped part way is a failure, with or without a baseline
+    if slower or any(result["error"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A compiled index of the images in swimages.yml. The file is parsed and every
+version is parsed once, then the index is cached on disk until the file
+changes. Each featureset of a family holds one image, or a list of images
+that apply to switches of given models or running given versions
+"""
+
+import fnmatch
+import hashlib
+import os
+import pickle
+import re
+
+from netdevices import version_key
+
+# Raise when Catalog or Target change, so catalogs cached by older code are
+# rebuilt rather than loaded with the wrong layout
+CACHE_FORMAT = 1
+
+
+class Target:
+    """An upgrade image. models is a glob, or a list of globs, that the
+    hardware model must match. min_version and max_version bound the version
+    the switch runs now, min included and max not. Both are optional"""
+
+    def __init__(self, entry):
+        self.image = entry["image"]
+        self.version = entry["version"]
+        self.md5 = entry.get("MD5", "").lower() or None
+        self.key = version_key(self.version)
+        models = entry.get("models")
+        if isinstance(models, str):
+            models = [models]
+        self.models = re.compile("|".join(
+            fnmatch.translate(model) for model in models)) if models else None
+        self.low = version_key(
+            entry["min_version"]) if "min_version" in entry else None
+        self.high = version_key(
+            entry["max_version"]) if "max_version" in entry else None
+
+    def matches(self, model, key):
+        """Returns True if the image applies to a switch of model running
+        the version with sort key key"""
+        if self.models is not None and not self.models.match(model):
+            return False
+        if self.low is not None and key < self.low:
+            return False
+        return self.high is None or key < self.high
+
+
+class Catalog:
+    """Looks up the upgrade image for a switch. The first image listed for
+    its family and featureset that matches the switch is used. Results are
+    remembered, so switches of the same kind are resolved once"""
+
+    def __init__(self, images):
+        self.targets = {}
+        for family, featuresets in images.items():
+            for featureset, entries in featuresets.items():
+                if isinstance(entries, dict):
+                    entries = [entries]
+                self.targets[family, featureset] = [
+                    Target(entry) for entry in entries
+                ]
+        self.families = {family for family, _ in self.targets}
+        self.resolved = {}
+
+    def match(self, family, featureset, model, version):
+        """Returns the Target for a switch. Raises KeyError naming the
+        family, featureset or model that has no image"""
+        lookup = (family, featureset, model, version)
+        if lookup not in self.resolved:
+            if family not in self.families:
+                raise KeyError(family)
+            if (family, featureset) not in self.targets:
+                raise KeyError(featureset)
+            key = version_key(version)
+            self.resolved[lookup] = next(
+                (target for target in self.targets[family, featureset]
+                 if target.matches(model, key)), None)
+        if self.resolved[lookup] is None:
+            raise KeyError(model)
+        return self.resolved[lookup]
+
+    def target(self, switch):
+        """Returns the Target for a Switch whose facts are known"""
+        return self.match(switch.family(), switch.featureset(),
+                          switch.allfacts["hardware"][0], switch.version())
+
+    def __getstate__(self):
+        # Resolved lookups belong to a run, not to the file
+        return {**self.__dict__, "resolved": {}}
+
+
+def load_catalog(path="../configs/swimages.yml",
+                 cache="../cache/catalog.pickle"):
+    """Returns the Catalog for an images file. The compiled catalog is kept
+    in cache along with the SHA-256 of the file and CACHE_FORMAT, and is
+    only rebuilt when either changes"""
+    with open(path, "rb") as images:
+        content = images.read()
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        with open(cache, "rb") as cached:
+            saved = pickle.load(cached)
+        if (saved.get("format") == CACHE_FORMAT
+                and saved["sha256"] == digest):
+            return saved["catalog"]
+    # A missing, old or damaged cache is simply rebuilt, whatever unpickling
+    # it raised
+    except Exception:
+        pass
+    # Only needed when the file changed, and slow to load
+    import yaml
+    catalog = Catalog(yaml.load(content, Loader=yaml.BaseLoader))
+    os.makedirs(os.path.dirname(cache) or ".", exist_ok=True)
+    temp = f"{cache}.{os.getpid()}.tmp"
+    with open(temp, "wb") as cached:
+        pickle.dump(
+            {
+                "format": CACHE_FORMAT,
+                "sha256": digest,
+                "catalog": catalog
+            }, cached)
+    os.replace(temp, cache)
+    return catalog
@@ -0,0 +1,119 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A pool of SSH sessions shared by every Switch. Each host gets one
+authenticated session, used for both CLI commands and SCP, and the number of
+open sessions is capped
+"""
+
+import threading
+import time
+
+
+class ConnectionPool:
+    """Hands out one netmiko session per host. With max_sessions, sessions
+    stay open while idle so later phases can reuse them. When they are all
+    open, the least recently used idle session is logged out to make room.
+    Idle sessions older than idle_timeout seconds are logged out on the next
+    request. keepalive is the SSH keepalive interval in seconds"""
+
+    def __init__(self, max_sessions=0, idle_timeout=300, keepalive=30):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.cond = threading.Condition()
+        self.sessions = {}
+        self.busy = set()
+        self.used = {}
+
+    def _close(self, host):
+        """Logs out of a host. Must be called with the lock held"""
+        connect = self.sessions.pop(host, None)
+        self.used.pop(host, None)
+        if connect is not None:
+            connect.disconnect()
+        self.cond.notify_all()
+
+    def _evict(self):
+        """Logs out of idle sessions past the idle timeout, then the least
+        recently used idle session if the pool is still full. Must be called
+        with the lock held"""
+        expired = time.monotonic() - self.idle_timeout
+        for host in [
+                h for h in self.sessions
+                if h not in self.busy and self.used[h] < expired
+        ]:
+            self._close(host)
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            idle = [h for h in self.sessions if h not in self.busy]
+            if idle:
+                self._close(min(idle, key=self.used.get))
+
+    def get(self, switch):
+        """Returns the session for a switch, logging in if needed. Blocks
+        while the pool is full of busy sessions"""
+        host = switch.host
+        with self.cond:
+            while True:
+                connect = self.sessions.get(host)
+                if connect is not None:
+                    if connect.is_alive():
+                        self.busy.add(host)
+                        self.used[host] = time.monotonic()
+                        return connect
+                    self._close(host)
+                self._evict()
+                if (not self.max_sessions
+                        or len(self.sessions) < self.max_sessions):
+                    # Hold the slot while logging in outside the lock
+                    self.sessions[host] = None
+                    self.busy.add(host)
+                    self.used[host] = time.monotonic()
+                    break
+                self.cond.wait()
+        try:
+            connect = switch.login()
+            connect.remote_conn_pre.get_transport().set_keepalive(
+                self.keepalive)
+        except Exception:
+            with self.cond:
+                self.sessions.pop(host, None)
+                self.busy.discard(host)
+                self.used.pop(host, None)
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.sessions[host] = connect
+        return connect
+
+    def transport(self, switch):
+        """Returns the SSH transport of a switch session, for SCP"""
+        return self.get(switch).remote_conn_pre.get_transport()
+
+    def done(self, host):
+        """Marks a host's session idle, so it can be reused or evicted. With
+        no max_sessions, nothing would bound the idle sessions kept for
+        later phases, so the session is logged out instead"""
+        with self.cond:
+            self.busy.discard(host)
+            if not self.max_sessions:
+                self._close(host)
+                return
+            self.used[host] = time.monotonic()
+            self.cond.notify_all()
+
+    def close(self, host):
+        """Logs out of a host"""
+        with self.cond:
+            self.busy.discard(host)
+            if host in self.sessions:
+                self._close(host)
+
+    def close_all(self):
+        """Logs out of every host"""
+        with self.cond:
+            for host in list(self.sessions):
+                self.busy.discard(host)
+                self._close(host)
+        return True
@@ -0,0 +1,117 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A persistent cache of switch facts, so a re-audit only contacts switches
+whose facts are stale or whose upgrade target has changed
+"""
+
+import json
+import os
+import time
+
+from netdevices import Switch
+
+
+def _target(allfacts, images):
+    """Returns the image and version the switch should be running according
+    to the images file, or None if it is not defined"""
+    switch = Switch(None, None, None)
+    switch.allfacts = dict(allfacts)
+    try:
+        target = images.target(switch)
+        return [target.image, target.version]
+    except (KeyError, IndexError, NameError):
+        return None
+
+
+class FactCache:
+    """Stores allfacts and flashinfo per host on disk. Entries older than ttl
+    seconds, or whose target image has changed since they were written, are
+    treated as missing, as are entries whose switch reports another serial
+    when it is contacted. Only the hosts stored or discarded here are
+    written back, so processes sharing the file keep each other's
+    entries"""
+
+    def __init__(self, path="../cache/facts.json", ttl=0):
+        self.path = path
+        self.ttl = ttl
+        self.entries = self._read()
+        self.changed = set()
+
+    def _read(self):
+        try:
+            with open(self.path) as cache:
+                return json.load(cache)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def load(self, host, images):
+        """Returns the cached (allfacts, flashinfo) for a host, or None if
+        the entry is missing or stale"""
+        entry = self.entries.get(host)
+        if not entry or time.time() - entry["time"] > self.ttl:
+            return None
+        if _target(entry["allfacts"], images) != entry["target"]:
+            return None
+        return dict(entry["allfacts"]), list(entry["flashinfo"])
+
+    def apply(self, switch, images):
+        """Fills the switch facts from the cache. Returns True if the cache
+        was used"""
+        cached = self.load(switch.host, images)
+        if cached is None:
+            return False
+        switch.allfacts, switch.flashinfo = cached
+        return True
+
+    def stale(self, hosts, images):
+        """Returns the hosts that would have to be contacted"""
+        return [host for host in hosts if self.load(host, images) is None]
+
+    def store(self, switch, images):
+        """Records the facts of a switch that has been fully checked"""
+        if not switch.allfacts.get("version") or not switch.allfacts.get(
+                "nbf"):
+            return False
+        self.entries[switch.host] = {
+            "serial": switch.allfacts.get("serial"),
+            "time": time.time(),
+            "target": _target(switch.allfacts, images),
+            "allfacts": switch.allfacts,
+            "flashinfo": switch.flashinfo,
+        }
+        self.changed.add(switch.host)
+        return True
+
+    def confirm(self, host, serial):
+        """Checks the serial a contacted switch reports against the one its
+        facts were cached with. A mismatch, such as a chassis replaced at the
+        same address, discards the entry. Returns True if the entry holds"""
+        entry = self.entries.get(host)
+        if entry is not None and serial and entry.get("serial") == serial:
+            return True
+        self.discard(host)
+        return False
+
+    def discard(self, host):
+        """Drops the entry for a host whose state has been changed"""
+        self.entries.pop(host, None)
+        self.changed.add(host)
+
+    def save(self):
+        """Writes the cache to disk"""
+        entries = self._read()
+        for host in self.changed:
+            if host in self.entries:
+                entries[host] = self.entries[host]
+            else:
+                entries.pop(host, None)
+        self.entries = entries
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Named per process, as workers may share the file
+        temp = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp, "w") as cache:
+            json.dump(self.entries, cache)
+        os.replace(temp, self.path)
+        return True
@@ -0,0 +1,205 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Runs commands or Switch methods across many switches, a bounded number at a
+time, and hands back the results of each switch as soon as they are in. For
+checks before and after a change, using the same Switch, connection pool and
+limits as swupgrade.py
+"""
+
+import argparse
+import getpass
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import Inventory
+from logger import Logger
+from netdevices import Switch
+
+
+class Result:
+    """The outcome of the tasks on one switch. values maps each task name
+    to what it returned. If a task raised, ok is False, error holds the
+    exception and values only the tasks done before it"""
+
+    __slots__ = ("host", "ok", "values", "error")
+
+    def __init__(self, host, values, error=None):
+        self.host = host
+        self.ok = error is None
+        self.values = values
+        self.error = error
+
+    def __repr__(self):
+        return f"Result({self.host!r}, ok={self.ok})"
+
+
+def _name(task):
+    """Returns the name a task's value is kept under"""
+    if isinstance(task, str):
+        return task
+    return getattr(task, "__name__", repr(task))
+
+
+class Fleet:
+    """Runs tasks on switches. A task is a CLI command, whose output is
+    returned, or a callable such as Switch.version that is called with the
+    Switch. With parse, command output is parsed as by Switch.send_parsed.
+    Up to workers switches are worked on at once, each in one session that
+    is released once its tasks are done. types maps a host to its device
+    type. options are passed on to each Switch, such as a ConnectionPool as
+    pool"""
+
+    def __init__(self,
+                 username,
+                 password,
+                 workers=10,
+                 parse=False,
+                 types=None,
+                 debug_on=False,
+                 **options):
+        self.username = username
+        self.password = password
+        self.workers = max(1, workers)
+        self.parse = parse
+        self.types = types or {}
+        self.debug_on = debug_on
+        self.options = options
+
+    def switch(self, host):
+        """Returns a new Switch for a host"""
+        return Switch(host,
+                      self.username,
+                      self.password,
+                      self.types.get(host, "cisco_ios"),
+                      debug_on=self.debug_on,
+                      **self.options)
+
+    def call(self, switch, task):
+        """Runs one task on a switch and returns its value"""
+        if not isinstance(task, str):
+            return task(switch)
+        if self.parse:
+            return switch.send_parsed(task)
+        return switch.ssh().send_command(task)
+
+    def check(self, host, tasks):
+        """Runs tasks, a dict of name to task, on one host in order. Returns
+        its Result. A task that raises stops the rest"""
+        switch = self.switch(host)
+        values = {}
+        try:
+            for name, task in tasks.items():
+                values[name] = self.call(switch, task)
+        except Exception as e:
+            return Result(host, values, e)
+        finally:
+            switch.release()
+        return Result(host, values)
+
+    def run(self, hosts, tasks):
+        """Returns an iterator over the Result of every host, in the order
+        they finish. tasks is a list of tasks, or a dict of name to task.
+        hosts is read on a background thread as the switches are worked
+        on, and no more than workers results wait to be taken, so a long
+        host list or a slow reader does not fill memory. An error reading
+        hosts is raised by the iterator"""
+        if not isinstance(tasks, dict):
+            tasks = {_name(task): task for task in tasks}
+        results = queue.Queue()
+        # A slot is held from when a host is read to when its result is
+        # taken
+        slots = threading.Semaphore(2 * self.workers)
+        stop = threading.Event()
+
+        def work(host):
+            results.put(self.check(host, tasks))
+
+        def feed():
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    for host in hosts:
+                        slots.acquire()
+                        if stop.is_set():
+                            break
+                        pool.submit(work, host)
+                results.put(None)
+            # Handed to the reading thread, such as quit() on a bad host list
+            except BaseException as e:
+                results.put(e)
+
+        threading.Thread(target=feed, daemon=True).start()
+
+        def collect():
+            try:
+                while True:
+                    result = results.get()
+                    if result is None:
+                        return
+                    if isinstance(result, BaseException):
+                        raise result
+                    slots.release()
+                    yield result
+            finally:
+                # Stops the feed if the reader gives up early
+                stop.set()
+                slots.release()
+
+        return collect()
+
+
+def main():
+    """Runs commands on a switch or a list of switches and prints each
+    result as a JSON line as soon as it is in"""
+    parser = argparse.ArgumentParser(description="run commands on switches")
+    host = parser.add_mutually_exclusive_group(required=True)
+    host.add_argument("--host", help="switch IP address")
+    host.add_argument("--list", help="file in ../iplists/ listing switches")
+    parser.add_argument("--user", help="username", required=True)
+    parser.add_argument("--command",
+                        help="Command to run, may be given more than once",
+                        action="append",
+                        required=True)
+    parser.add_argument("--parse",
+                        help="Parse the output of each command",
+                        action="store_true")
+    parser.add_argument("--workers",
+                        help="Number of switches to work on at once",
+                        type=int,
+                        default=10)
+    parser.add_argument("--port",
+                        help="SSH port of the switches",
+                        type=int,
+                        default=22)
+    args = parser.parse_args()
+    inventory = Inventory(Logger(["VALIDATE HOSTS"]))
+    try:
+        hosts = inventory.hosts([args.host]) if args.host else inventory.load(
+            f"../iplists/{args.list}")
+    except FileNotFoundError as e:
+        Logger("[FLEET]").error(e)
+        return False
+    fleet = Fleet(args.user,
+                  getpass.getpass("Password: "),
+                  args.workers,
+                  parse=args.parse,
+                  types=inventory.types,
+                  port=args.port)
+    for result in fleet.run(hosts, args.command):
+        print(json.dumps(
+            {
+                "host": result.host,
+                "ok": result.ok,
+                "values": result.values,
+                "error": None if result.ok else str(result.error),
+            },
+            default=str),
+              flush=True)
+    return True
+
+
+if __name__ == "__main__":
+    main()
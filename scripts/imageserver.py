@@ -0,0 +1,135 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A small HTTP server for the images directory. Switches are told to copy the
+image from it themselves, so many switches can pull at once without the
+transfer passing through SSH on this host
+"""
+
+import functools
+import os
+import re
+import threading
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+_range = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class _RangeHandler(SimpleHTTPRequestHandler):
+    """Serves files with support for a single byte range, and counts the
+    bytes sent to each client"""
+
+    def send_head(self):
+        self.range = None
+        match = _range.match(self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, end = match.groups()
+        if start:
+            start, end = int(start), int(end) if end else size - 1
+        else:
+            start, end = size - int(end or 0), size - 1
+        end = min(end, size - 1)
+        if start < 0 or start > end:
+            self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return None
+        image = open(path, "rb")
+        image.seek(start)
+        self.range = (start, end)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return image
+
+    def copyfile(self, source, outputfile):
+        remaining = None
+        if self.range:
+            remaining = self.range[1] - self.range[0] + 1
+        host = self.client_address[0]
+        while remaining is None or remaining > 0:
+            chunk = source.read(64 * 1024 if remaining is None else min(
+                64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self.server.count(host, len(chunk))
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def end_headers(self):
+        if not getattr(self, "range", None):
+            self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, bandwidth=None):
+        super().__init__(address, handler)
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.sent = {}
+
+    def count(self, host, count):
+        if self.bandwidth is not None:
+            self.bandwidth.consume(count)
+        with self.lock:
+            self.sent[host] = self.sent.get(host, 0) + count
+
+
+class ImageServer:
+    """Serves the images directory over HTTP on a background thread. address
+    is where switches reach this host, bind is the local address to listen
+    on. bandwidth, if given, paces everything served"""
+
+    def __init__(self,
+                 address,
+                 port=8080,
+                 directory="../images/",
+                 bind="",
+                 bandwidth=None):
+        self.address = address
+        handler = functools.partial(_RangeHandler,
+                                    directory=os.path.abspath(directory))
+        self.httpd = _Server((bind, port), handler, bandwidth)
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """Starts serving in the background"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return True
+
+    def url(self, file):
+        """Returns the URL a switch should copy file from"""
+        return f"http://{self.address}:{self.port}/{file}"
+
+    def sent(self, host):
+        """Returns the number of bytes served to a host so far"""
+        with self.httpd.lock:
+            return self.httpd.sent.get(host, 0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
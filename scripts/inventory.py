@@ -0,0 +1,104 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Streams hosts from an iplist. Each line holds an IP address, a CIDR range or
+a hostname, optionally followed by key=value metadata such as site=LON1 or
+type=cisco_ios. Anything after a # is a comment. Ranges are expanded as they
+are read and hosts that have already been seen are skipped
+"""
+
+import ipaddress
+import re
+
+# A DNS hostname, RFC 1123 labels separated by dots
+_hostname = re.compile(r"(?!-)[A-Za-z0-9-]{1,63}(?<!-)"
+                       r"(\.(?!-)[A-Za-z0-9-]{1,63}(?<!-))*\.?")
+
+
+def _expand(item):
+    """Returns an iterator over the hosts of an address, range or hostname.
+    Raises ValueError if it is none of them"""
+    if "/" in item:
+        network = ipaddress.ip_network(item, strict=False)
+        if network.num_addresses == 1:
+            return iter([str(network.network_address)])
+        return (str(host) for host in network.hosts())
+    try:
+        return iter([str(ipaddress.ip_address(item))])
+    except ValueError:
+        # Every part of a hostname being a number means a bad address
+        if (len(item) > 253 or not _hostname.fullmatch(item)
+                or item.replace(".", "").isdigit()):
+            raise
+        return iter([item.lower()])
+
+
+def site_of(host, prefix=24, names=None):
+    """Returns the site a host belongs to: its named site in names, else
+    the subnet of its address with the given prefix length. A hostname
+    without a named site is a site of its own"""
+    if names and host in names:
+        return names[host]
+    try:
+        return str(ipaddress.ip_network(f"{host}/{prefix}", strict=False))
+    except ValueError:
+        return host
+
+
+class Inventory:
+    """Reads hosts and their metadata. meta holds the metadata of every host
+    that had any, sites and types the site and device type of every host
+    that was given one, all keyed by host. Only the first entry for a host
+    counts"""
+
+    def __init__(self, log):
+        self.log = log
+        self.meta = {}
+        self.sites = {}
+        self.types = {}
+        self.seen = set()
+        self.invalid = 0
+
+    def hosts(self, lines):
+        """Yields every new host in lines as soon as it is read"""
+        for number, line in enumerate(lines, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            item, *fields = line.split()
+            try:
+                meta = dict(field.split("=", 1) for field in fields)
+                hosts = _expand(item)
+            except ValueError:
+                self.invalid += 1
+                self.log.error(f"{line} - INVALID ENTRY", f"line {number}")
+                continue
+            for host in hosts:
+                if host in self.seen:
+                    self.log.debug(f"{host} - Duplicate, skipped")
+                    continue
+                self.seen.add(host)
+                if meta:
+                    self.meta[host] = meta
+                if "site" in meta:
+                    self.sites[host] = meta["site"]
+                if "type" in meta:
+                    self.types[host] = meta["type"]
+                self.log.debug(f"{host} - Valid host")
+                yield host
+
+    def load(self, path):
+        """Returns an iterator over every new host in a file, which reads it
+        a line at a time. A missing file raises FileNotFoundError at once"""
+        lines = open(path)
+
+        def read():
+            with lines:
+                yield from self.hosts(lines)
+
+        return read()
+
+    def get(self, host, key, default=None):
+        """Returns a metadata value for a host"""
+        return self.meta.get(host, {}).get(key, default)
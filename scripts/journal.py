@@ -0,0 +1,113 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A crash safe journal of every run. The result of each phase for each host is
+committed to an SQLite database as soon as it is known, so a run that was
+interrupted can be resumed from where it stopped
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL,
+    phases TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    detail TEXT,
+    time REAL NOT NULL,
+    PRIMARY KEY (run, host, phase)
+);
+"""
+
+
+class Journal:
+    """Records the phase results of a run. start begins a new run, or picks
+    up the last one. Results of a resumed run are loaded into memory once,
+    and later results for the same host and phase replace them"""
+
+    def __init__(self, path="../cache/journal.db"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        # Every statement commits on its own, so nothing is lost on a crash
+        self.db = sqlite3.connect(path,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_schema)
+        self.run = None
+        self.resumed = {}
+
+    def start(self, phases, resume=False):
+        """Starts a run of phases, a list of phase names. With resume, the
+        last run is continued instead, whether it was interrupted or
+        finished with hosts that failed. Returns True if a run was
+        resumed"""
+        with self.lock:
+            last = self.db.execute(
+                "SELECT id FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+            if resume and last:
+                self.run = last[0]
+                self.db.execute(
+                    "UPDATE runs SET phases = ?, finished = NULL WHERE id = ?",
+                    (json.dumps(phases), self.run))
+                for host, phase, ok, detail in self.db.execute(
+                        "SELECT host, phase, ok, detail FROM results "
+                        "WHERE run = ?", (self.run, )):
+                    self.resumed.setdefault(host, {})[phase] = (
+                        bool(ok), json.loads(detail) if detail else None)
+                return True
+            self.run = self.db.execute(
+                "INSERT INTO runs (started, phases) VALUES (?, ?)",
+                (time.time(), json.dumps(phases))).lastrowid
+            return False
+
+    def record(self, host, phase, ok, detail=None):
+        """Commits the result of a phase for a host. detail is any JSON
+        serialisable value"""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run, host, phase, int(bool(ok)),
+                 None if detail is None else json.dumps(detail), time.time()))
+        return True
+
+    def state(self, host):
+        """Returns the results of the resumed run for a host, as a dict of
+        phase to (ok, detail)"""
+        return self.resumed.get(host, {})
+
+    def results(self):
+        """Returns the results of the current run as a list of (host, phase,
+        ok)"""
+        with self.lock:
+            return [(host, phase, bool(ok))
+                    for host, phase, ok in self.db.execute(
+                        "SELECT host, phase, ok FROM results WHERE run = ? "
+                        "ORDER BY time", (self.run, ))]
+
+    def finish(self):
+        """Marks the run as having reached the end"""
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                            (time.time(), self.run))
+        return True
+
+    def close(self):
+        """Closes the database"""
+        with self.lock:
+            self.db.close()
+        return True
@@ -1,18 +1,198 @@
 # !/usr/bin/env python3
 
 # LiamJordan. For support: lsjordan.uk@gmail.com
-# A class to handle logging
+# A class to handle logging. Records are handed to a background writer, so a
+# worker never waits on the terminal. The writer can print human readable or
+# JSON lines, group the lines of each host together and print a summary
+
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
 
 from colorama import init
 from termcolor import colored as c
 
+# Initialise colorama to allow colours to work on Windows systems. Done once,
+# as every call wraps stdout again
+init()
+
+
+def _host_of(message):
+    """Returns the host a shared logger message is about, from the usual
+    "HOST - message" form, or None"""
+    head, sep, _ = str(message).partition(" - ")
+    if sep and head and " " not in head:
+        return head
+    return None
+
+
+def _human(record):
+    """Formats a record the way Logger has always printed it"""
+    _, type, prefix, message, color, status, status_color, _ = record
+    if prefix:
+        line = c(f"[{type}] - {prefix}: {message}", color)
+    else:
+        line = c(f"[{type}] - {message}", color)
+    if status:
+        line += c(f" - {status}", status_color)
+    return line
+
+
+def _json(record):
+    when, type, prefix, message, _, status, _, host = record
+    return json.dumps(
+        {
+            "time": when,
+            "level": type,
+            "host": host,
+            "prefix": prefix,
+            "message": message,
+            "status": status,
+        },
+        default=str)
+
+
+class _Writer:
+    """Writes records from a queue on a daemon thread. When grouping, the
+    lines of each host are held back until that host is flushed. Records
+    are only counted per host when a summary is wanted"""
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.format = _human
+        self.group = False
+        self.count = False
+        self.buffers = {}
+        self.counts = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run,
+                                                   daemon=True)
+                    self.thread.start()
+        self.queue.put(item)
+
+    def run(self):
+        dirty = set()
+        while True:
+            item = self.queue.get()
+            if item[0] == "record":
+                self.record(item[1], item[2], dirty)
+            elif item[0] == "flush":
+                self.flush(item[1], dirty)
+            elif item[0] == "summary":
+                self.flush(None, dirty)
+                self.write(item[1], self.summary(), dirty)
+            elif item[0] == "configure":
+                self.flush(None, dirty)
+                self.format, self.group, self.count = item[1:4]
+            if item[-1] is not None and item[0] != "record":
+                item[-1].set()
+            # The streams are flushed once the queue runs dry, not per line
+            if self.queue.empty():
+                for stream in dirty:
+                    try:
+                        stream.flush()
+                    except (OSError, ValueError):
+                        pass
+                dirty.clear()
+
+    def record(self, stream, record, dirty):
+        host = record[-1] or _host_of(record[3])
+        record = record[:-1] + (host, )
+        if self.count and host is not None:
+            counts = self.counts.setdefault(host, {})
+            counts[record[1]] = counts.get(record[1], 0) + 1
+        line = self.format(record)
+        if self.group and host is not None:
+            self.buffers.setdefault(host, []).append((stream, line))
+            return
+        self.write(stream, line, dirty)
+
+    def write(self, stream, text, dirty):
+        try:
+            stream.write(text + "\n")
+            dirty.add(stream)
+        # A closed or redirected stream only loses its own lines
+        except (OSError, ValueError):
+            pass
+
+    def flush(self, host, dirty):
+        hosts = list(self.buffers) if host is None else [host]
+        for name in hosts:
+            for stream, line in self.buffers.pop(name, []):
+                self.write(stream, line, dirty)
+
+    def summary(self):
+        """Returns a table of how many records of each type every host
+        had"""
+        types = ["INFO", "SUCCESS", "ERROR"]
+        if self.format is _json:
+            return json.dumps({"summary": self.counts})
+        width = max([len(host) for host in self.counts] + [4])
+        lines = [
+            f"{'HOST':<{width}}  " + "  ".join(f"{t:>7}" for t in types)
+        ]
+        totals = dict.fromkeys(types, 0)
+        for host, counts in self.counts.items():
+            for t in types:
+                totals[t] += counts.get(t, 0)
+            color = "red" if counts.get("ERROR") else "green"
+            lines.append(
+                c(
+                    f"{host:<{width}}  " +
+                    "  ".join(f"{counts.get(t, 0):>7}" for t in types),
+                    color))
+        lines.append(f"{'TOTAL':<{width}}  " +
+                     "  ".join(f"{totals[t]:>7}" for t in types))
+        return "\n".join(lines)
+
+
+_writer = _Writer()
+
+
+def _wait(item):
+    done = threading.Event()
+    _writer.put(item + (done, ))
+    done.wait()
+
+
+def configure(format="human", group=False, count=False):
+    """Sets the output format, human or json, whether the lines of each host
+    are grouped together, and whether they are counted for summary"""
+    _wait(("configure", _json if format == "json" else _human, group, count))
+
+
+def flush(host=None, wait=True):
+    """Writes out everything logged so far. With grouping, host only writes
+    out the lines held back for that host"""
+    item = ("flush", host)
+    if wait:
+        _wait(item)
+    else:
+        _writer.put(item + (None, ))
+
+
+def summary():
+    """Prints a table of the records logged for every host"""
+    _wait(("summary", sys.stdout))
+
+
+atexit.register(flush)
+
 
 class Logger:
-    def __init__(self, prefix=None, debug_on=False):
-        # Initialise colorama to allow colours to work on Windows systems
-        init()
+    def __init__(self, prefix=None, debug_on=False, host=None):
         self.debug_on = debug_on
         self.prefix = prefix
+        self.host = host
         self.error_color = "red"
         self.success_color = "green"
         self.info_color = "white"
@@ -46,20 +226,16 @@ class Logger:
                 self.log("DEBUG", message, self.debug_color)
 
     def log(self, type, message, color, status=None, status_color=None):
-        if status:
-            if self.prefix:
-                print(
-                    c(f"[{type}] - {self.prefix}: {message}", color) +
-                    c(f" - {status}", status_color))
-            else:
-                print(
-                    c(f"[{type}] - {message}", color) +
-                    c(f" - {status}", status_color))
-        else:
-            if self.prefix:
-                print(c(f"[{type}] - {self.prefix}: {message}", color))
-            else:
-                print(c(f"[{type}] - {message}", color))
+        # Formatting and writing happen on the writer thread. The stream is
+        # taken now, so a redirect of stdout still applies
+        _writer.put(("record", sys.stdout,
+                     (time.time(), type, self.prefix, message, color, status,
+                      status_color, self.host)))
+
+    def flush(self):
+        """Writes out the lines held back for the host of this logger"""
+        if self.host is not None:
+            flush(self.host, wait=False)
 
 
 def main():
@@ -6,13 +6,27 @@ A file containing network device classes
 """
 
 import datetime as dt
+import functools
+import os
+import re
 import time
-
-import paramiko
-from netmiko import ConnectHandler
-from scp import SCPClient
+from contextlib import nullcontext
 
 from logger import Logger
+from parsers import parse
+from tracing import TracedConnection, timed
+
+
+# Every command check_upgrade needs, collected in one burst by Switch.collect
+FACT_COMMANDS = [
+    "show ver",
+    "show boot | i BOOT path-list",
+    "dir /recursive flash:",
+]
+
+_prompt = re.compile(r"^[\w.\-]+[#>]")
+_md5 = re.compile(r"=\s*([0-9a-fA-F]{32})")
+_version_part = re.compile(r"\d+|[A-Za-z]+")
 
 
 class InvalidConfigCommand(Exception):
@@ -20,6 +34,100 @@ class InvalidConfigCommand(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=None)
+def transfer_errors():
+    """Returns the errors that may interrupt a file transfer part way
+    through. The SSH libraries are only loaded once a switch is contacted"""
+    import paramiko
+    from scp import SCPException
+    return (OSError, EOFError, paramiko.SSHException, SCPException)
+
+
+@functools.lru_cache(maxsize=None)
+def switch_errors():
+    """Returns the errors that end the work on one switch, but need not stop
+    the work on the rest of the fleet"""
+    from netmiko import exceptions
+    # netmiko 4 raises read timeouts from a base of its own
+    base = getattr(exceptions, "NetmikoBaseException", EOFError)
+    return (*transfer_errors(), base, InvalidConfigCommand)
+
+
+def split_output(output, commands):
+    """Splits the output of several commands sent in one burst into a dict
+    of command: output. Command echoes and prompts are removed"""
+    sections = {}
+    pending = list(commands)
+    current = None
+    for line in output.splitlines():
+        stripped = line.rstrip()
+        if pending and stripped.endswith(pending[0]) and (
+                stripped == pending[0] or _prompt.match(stripped)):
+            current = pending.pop(0)
+            sections[current] = []
+        elif _prompt.match(stripped):
+            current = None
+        elif current is not None:
+            sections[current].append(line)
+    return {
+        command: "\n".join(lines).strip("\n")
+        for command, lines in sections.items()
+    }
+
+
+def boot_path(output):
+    """Returns the boot path from show boot output in a standard format"""
+    path = output.split(" : ")[-1].strip().strip("flash:")
+    if "/" not in path:
+        path = f"/{path}"
+    return path
+
+
+def file_size(entries):
+    """Returns the size of a file from parsed dir output, or None if the
+    file does not exist"""
+    if isinstance(entries, list):
+        for entry in entries:
+            if "d" not in entry["permissions"]:
+                return int(entry["size"])
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def version_key(text):
+    """Returns a sort key for an IOS version such as 15.2(7)E2. Numbers
+    compare as numbers and sort before letters, so 15.2(4)E8 < 15.2(7)E2.
+    A fleet runs few distinct versions, so each is only parsed once"""
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part)
+                 for part in _version_part.findall(text))
+
+
+def reload_command(minutes):
+    """Returns the command that reloads a switch in minutes"""
+    return f"reload in {minutes}" if minutes else "reload"
+
+
+def md5_from_output(output):
+    """Returns the hash from verify /md5 output, or None"""
+    match = _md5.search(output)
+    return match.group(1).lower() if match else None
+
+
+def copy_state(output, answered=0):
+    """Works out the state of an interactive copy command from its output.
+    Returns done, error, prompt or None if it is still running. Only a
+    prompt after the first answered characters counts, so a prompt is not
+    reported again once it has been answered"""
+    if "bytes copied" in output:
+        return "done"
+    if "%Error" in output:
+        return "error"
+    lines = output[answered:].strip().splitlines()
+    if lines and (lines[-1].endswith("?") or lines[-1].endswith("[confirm]")):
+        return "prompt"
+    return None
+
+
 def _progress(status, total, count):
     """A function to display a progress bar out to the terminal. Used in the
     copy file function"""
@@ -44,41 +152,94 @@ class Switch:
                  username,
                  password,
                  type="cisco_ios",
-                 debug_on=False):
+                 debug_on=False,
+                 pool=None,
+                 backups=None,
+                 tracer=None,
+                 port=22):
         self.host = host
-        self.log = Logger(self.host, debug_on)
+        self.log = Logger(self.host, debug_on, host=self.host)
         self.username = username
         self.password = password
         self.type = type
+        self.port = port
+        self.pool = pool
+        self.backups = backups
+        self.tracer = tracer
         self.connect = None
         self.allfacts = {}
         self.flashinfo = []
         self.log.debug("[__init__] complete")
 
     def ssh(self):
-        """Establishes an SSH connection"""
+        """Establishes an SSH connection, taken from the connection pool if
+        the switch has one"""
         self.log.debug("Executing [ssh]")
-        if not self.connect:
-            self.connect = ConnectHandler(
+        if self.pool is not None:
+            self.connect = self.pool.get(self)
+        else:
+            if not self.connect:
+                self.connect = self.login()
+            if not self.connect.is_alive():
+                self.connect = None
+                self.connect = self.ssh()
+        self.log.debug("[ssh] complete")
+        if self.tracer is not None:
+            return TracedConnection(self.connect, self.tracer, self.host)
+        return self.connect
+
+    def login(self):
+        """Opens a new netmiko session to the switch"""
+        from netmiko import ConnectHandler
+        with self.span("connect", "command"):
+            return ConnectHandler(
                 ip=self.host,
+                port=self.port,
                 username=self.username,
                 password=self.password,
                 device_type=self.type,
             )
-        if not self.connect.is_alive():
-            self.connect = None
-            self.connect = self.ssh()
-        self.log.debug("[ssh] complete")
-        return self.connect
 
+    def span(self, name, kind):
+        """Times a block if the switch has a tracer"""
+        if self.tracer is None:
+            return nullcontext({})
+        return self.tracer.span(self.host, name, kind)
+
+    def release(self):
+        """Hands the connection back to the pool once the current phase is
+        done with the switch. Without a pool the session is logged out"""
+        if self.pool is not None:
+            self.pool.done(self.host)
+        elif self.connect is not None:
+            self.connect.disconnect()
+        self.connect = None
+        self.log.flush()
+        return True
+
+    def drop_session(self):
+        """Logs out of a session that a failure may have broken, so the next
+        command opens a new one"""
+        if self.pool is not None:
+            self.pool.close(self.host)
+        elif self.connect is not None:
+            self.connect.disconnect()
+        self.connect = None
+        return True
+
+    def send_parsed(self, command):
+        """Runs an exec command and returns its parsed output"""
+        return parse(self.ssh().send_command(command), self.type, command)
+
+    @timed
     def facts(self):
         """Gathers basic facts by running show version on the switch"""
         self.log.debug("Executing [base_facts]")
-        self.allfacts.update(self.ssh().send_command("show ver",
-                                                     use_textfsm=True)[0])
+        self.allfacts.update(self.send_parsed("show ver")[0])
         self.log.debug("[base_facts] complete")
         return self.allfacts
 
+    @timed
     def running_image(self):
         """returns the current running_image in a standard format"""
         self.log.debug("Executing [running_image]")
@@ -90,6 +251,7 @@ class Switch:
         self.log.debug("[running_image] complete")
         return self.allfacts["running_image"]
 
+    @timed
     def next_boot_file(self):
         """returns the bootfile configuration from running config in a standard
         format. This may not be the current boot image, but will be the
@@ -97,14 +259,12 @@ class Switch:
         upgrade is in progress."""
         self.log.debug("Executing [next_boot_file]")
         if not self.allfacts.get("nbf"):
-            self.allfacts["nbf"] = (
-                self.ssh().send_command("show boot | i BOOT path-list").split(
-                    " : ")[-1].strip("flash:"))
-        if "/" not in self.allfacts["nbf"]:
-            self.allfacts["nbf"] = f"/{self.allfacts['nbf']}"
+            self.allfacts["nbf"] = boot_path(
+                self.ssh().send_command("show boot | i BOOT path-list"))
         self.log.debug("[next_boot_file] complete")
         return self.allfacts["nbf"]
 
+    @timed
     def reload_pending(self):
         """Checks if a reload is pending on the switch by comparing the current
         bootfile with the next_boot_file"""
@@ -116,6 +276,7 @@ class Switch:
             self.log.debug("[reload_pending] complete")
             return True
 
+    @timed
     def stacked(self):
         """Identifies if a switch is stacked by checking the number of serial
         numbers provided"""
@@ -130,6 +291,7 @@ class Switch:
         self.log.debug("[stacked] complete")
         return self.allfacts["stacked"]
 
+    @timed
     def ios_xe(self):
         """Checks if the current IOS bootfile is an IOS-XE version"""
         self.log.debug("Executing [ios_xe]")
@@ -141,6 +303,7 @@ class Switch:
         self.log.debug("[ios_xe] complete")
         return self.allfacts["ios_xe"]
 
+    @timed
     def version(self):
         """Returns the switch IOS version"""
         self.log.debug("Executing [version]")
@@ -149,6 +312,7 @@ class Switch:
         self.log.debug("[version] complete")
         return self.allfacts["version"]
 
+    @timed
     def featureset(self):
         """Returns the switch featureset"""
         self.log.debug("Executing [featureset]")
@@ -165,6 +329,7 @@ class Switch:
         self.log.debug("[featureset] complete")
         return self.allfacts["featureset"]
 
+    @timed
     def family(self):
         """Returns the switch family"""
         self.log.debug("Executing [family]")
@@ -178,17 +343,52 @@ class Switch:
         self.log.debug("[family] complete")
         return self.allfacts["family"]
 
+    @timed
     def flash(self):
         """Gets the current flash information"""
         self.log.debug("Executing [flash]")
-        self.flashinfo = self.ssh().send_command("dir", use_textfsm=True)
+        self.flashinfo = self.send_parsed("dir")
         for item in self.flashinfo[:]:
             if "d" in item['permissions']:
-                self.flashinfo.extend(self.ssh().send_command(
-                    f"dir {item['name']}", use_textfsm=True))
+                self.flashinfo.extend(self.send_parsed(f"dir {item['name']}"))
         self.log.debug("[flash] complete")
         return self.flashinfo
 
+    @timed
+    def burst(self, commands, read_timeout=60):
+        """Sends several commands without waiting for each prompt, then
+        reads the whole burst back. Returns a dict of command: output"""
+        self.log.debug("Executing [burst]")
+        connect = self.ssh()
+        prompt = re.escape(connect.find_prompt())
+        connect.write_channel("".join(f"{command}{connect.RETURN}"
+                                      for command in commands))
+        output = connect.read_until_pattern(
+            pattern=rf"(?:[\s\S]*?{prompt}){{{len(commands)}}}",
+            read_timeout=read_timeout,
+        )
+        self.log.debug("[burst] complete")
+        return split_output(output, commands)
+
+    @timed
+    def load_facts(self, sections):
+        """Fills allfacts and flashinfo from the output of FACT_COMMANDS"""
+        self.allfacts.update(
+            parse(sections[FACT_COMMANDS[0]], self.type, "show version")[0])
+        self.allfacts["nbf"] = boot_path(sections[FACT_COMMANDS[1]])
+        self.flashinfo = parse(sections[FACT_COMMANDS[2]], self.type, "dir")
+        return self.allfacts
+
+    @timed
+    def collect(self):
+        """Gathers everything check_upgrade needs in a single round trip,
+        instead of one command per accessor and per flash directory"""
+        self.log.debug("Executing [collect]")
+        self.load_facts(self.burst(FACT_COMMANDS))
+        self.log.debug("[collect] complete")
+        return self.allfacts
+
+    @timed
     def file_on_flash(self, file):
         """Checks if the given file exists on Flash"""
         self.log.debug("Executing [file_on_flash]")
@@ -202,6 +402,7 @@ class Switch:
         self.log.debug("[file_on_flash] complete")
         return False
 
+    @timed
     def free_space(self):
         """Returns the available space on flash in bytes"""
         self.log.debug("Executing [free_space]")
@@ -210,6 +411,7 @@ class Switch:
         self.log.debug("[free_space] complete")
         return self.flashinfo[0]["total_free"]
 
+    @timed
     def save_config(self):
         """Saves the current running config"""
         self.log.debug("Executing [save_config]")
@@ -217,38 +419,208 @@ class Switch:
         self.log.debug("[save_config] complete")
         return True
 
-    def backup_config(self, path="../backups/"):
-        """Takes a copy of the current running config and saves it to the
-        backup directory"""
+    @timed
+    def backup_config(self, path="../backups/", phase=None):
+        """Takes a copy of the current running config. It is saved to the
+        backup store if the switch has one, otherwise to a timestamped file in
+        the backup directory"""
         self.log.debug("Executing [backup_config]")
-        self.ssh().send_command("show run")
+        self.save_backup(self.ssh().send_command("show run"), path, phase)
+        self.log.debug("[backup_config] complete")
+        return True
+
+    def save_backup(self, config, path="../backups/", phase=None):
+        """Saves a running config fetched by backup_config"""
+        if self.backups is not None:
+            self.backups.store(self.host, config, phase)
+            return True
         timestamp = dt.datetime.fromtimestamp(
             time.time()).strftime("%d%m%Y-%H%M%S")
-        print(
-            self.ssh().send_command("show run"),
-            file=open(f"{path}{self.host}-{timestamp}.ios", "a"),
-        )
-        self.log.debug("[backup_config] complete")
+        with open(f"{path}{self.host}-{timestamp}.ios", "a") as backup:
+            print(config, file=backup)
+        return True
+
+    @timed
+    def remote_size(self, path):
+        """Returns the size of a file on flash in bytes, or None"""
+        self.log.debug("Executing [remote_size]")
+        size = file_size(self.send_parsed(f"dir {path}"))
+        self.log.debug("[remote_size] complete")
+        return size
+
+    @timed
+    def remote_md5(self, path):
+        """Returns the MD5 hash of a file on flash"""
+        self.log.debug("Executing [remote_md5]")
+        md5 = md5_from_output(self.ssh().send_command(f"verify /md5 {path}",
+                                                      read_timeout=600))
+        self.log.debug("[remote_md5] complete")
+        return md5
+
+    @timed
+    def delete_file(self, path):
+        """Deletes a file from flash"""
+        self.log.debug("Executing [delete_file]")
+        self.ssh().send_command_timing(f"delete /force {path}")
+        self.log.debug("[delete_file] complete")
         return True
 
-    def send_file(self, file, destination):
-        """Transfers a given file to switch flash memory"""
+    @timed
+    def file_landed(self, file, destination, md5=None):
+        """Checks if a complete copy of file is already at destination, by
+        size and, when md5 is given, by hash"""
+        if self.remote_size(destination) != os.path.getsize(file):
+            return False
+        return md5 is None or self.remote_md5(destination) == md5
+
+    @timed
+    def send_file(self,
+                  file,
+                  destination,
+                  progress=_progress,
+                  retries=0,
+                  md5=None,
+                  checkpoint=None):
+        """Transfers a given file to switch flash memory. progress is called
+        with the file name, size and bytes sent as the transfer runs. A file
+        that has already fully landed is not sent again. A dropped transfer
+        has its partial file removed and is retried up to retries times. The
+        partial file of the last attempt is removed as well. checkpoint
+        records how far each attempt got"""
         self.log.debug("Executing [send_file]")
+        if self.file_landed(file, destination, md5):
+            self.log.info("File already on flash, skipping transfer")
+            if checkpoint is not None:
+                checkpoint.record(self.host, file, os.path.getsize(file),
+                                  "complete")
+            return True
+        for attempt in range(retries + 1):
+            sent = [0]
+
+            def track(filename, size, count):
+                sent[0] = count
+                if progress:
+                    progress(filename, size, count)
+
+            try:
+                self._scp(file, destination, track)
+                if checkpoint is not None:
+                    checkpoint.record(self.host, file, sent[0], "complete")
+                self.log.debug("[send_file] complete")
+                return True
+            except transfer_errors() as e:
+                self.log.error(f"Transfer dropped at {sent[0]} bytes", str(e))
+                if checkpoint is not None:
+                    checkpoint.record(self.host, file, sent[0], "failed")
+                if attempt < retries:
+                    time.sleep(2**attempt)
+                # The partial file goes after the last attempt too, so a
+                # failed transfer never leaves it filling flash
+                self.remove_partial(destination)
+        self.log.debug("[send_file] complete")
+        return False
+
+    def remove_partial(self, destination):
+        """Removes the partial file of a failed transfer. The drop may have
+        taken the session with it, so a new one is opened. Returns False if
+        the file could not be removed, which does not stop a retry"""
+        self.drop_session()
+        try:
+            self.delete_file(destination)
+        except switch_errors() as e:
+            self.log.error(f"Could not remove {destination}", str(e))
+            self.drop_session()
+            return False
+        return True
+
+    @timed
+    def pull_file(self,
+                  url,
+                  destination,
+                  progress=None,
+                  timeout=3600,
+                  poll=5,
+                  retries=0):
+        """Has the switch copy a file from url to flash itself, then polls the
+        session until the copy finishes. progress is called on every poll. A
+        failed copy has its partial file removed and is retried up to
+        retries times, as send_file does"""
+        self.log.debug("Executing [pull_file]")
+        for attempt in range(retries + 1):
+            try:
+                if self._pull(url, destination, progress, timeout, poll):
+                    self.log.debug("[pull_file] complete")
+                    return True
+                self.log.error("Copy from image server failed")
+            except switch_errors() as e:
+                self.log.error("Copy from image server dropped", str(e))
+            if attempt < retries:
+                time.sleep(2**attempt)
+            self.remove_partial(destination)
+        self.log.debug("[pull_file] complete")
+        return False
+
+    def _pull(self, url, destination, progress, timeout, poll):
+        """Runs one copy from url, answering its prompts. Returns True if it
+        finished"""
+        connect = self.ssh()
+        connect.write_channel(f"copy {url} {destination}{connect.RETURN}")
+        output = ""
+        answered = 0
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(poll)
+            output += connect.read_channel()
+            if progress:
+                progress()
+            state = copy_state(output, answered)
+            if state == "prompt":
+                connect.write_channel(connect.RETURN)
+                answered = len(output)
+            elif state:
+                break
+        return copy_state(output) == "done"
+
+    def _scp(self, file, destination, progress):
+        """Copies a file to the switch over SCP. With a connection pool the
+        CLI session's transport is reused, unless the switch refuses a second
+        channel on it"""
+        import paramiko
+        if self.pool is not None:
+            try:
+                return self._scp_put(self.pool.transport(self), file,
+                                     destination, progress)
+            except paramiko.ChannelException:
+                self.log.debug("Second channel refused, opening SCP session")
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         ssh.connect(
             hostname=self.host,
+            port=self.port,
             username=self.username,
             password=self.password,
             allow_agent=False,
             look_for_keys=False,
         )
-        scp = SCPClient(ssh.get_transport(), progress=_progress)
-        scp.put(file, destination)
-        scp.close()
-        self.log.debug("[send_file] complete")
+        try:
+            return self._scp_put(ssh.get_transport(), file, destination,
+                                 progress)
+        finally:
+            ssh.close()
+
+    def _scp_put(self, transport, file, destination, progress):
+        """Puts a file over SCP on an existing SSH transport"""
+        from scp import SCPClient
+        scp = SCPClient(transport, progress=progress)
+        try:
+            with self.span("scp", "transfer") as span:
+                span["bytes"] = os.path.getsize(file)
+                scp.put(file, destination)
+        finally:
+            scp.close()
         return True
 
+    @timed
     def send_config(self, command):
         """Sends the given configuration command string to the switch"""
         self.log.debug("Executing [send_config]")
@@ -257,12 +629,55 @@ class Switch:
         self.log.debug("[send_config] complete")
         return True
 
-    def reload(self):
-        """Reload the switch"""
+    @timed
+    def reload(self, minutes=5):
+        """Reload the switch in the given number of minutes, or straight away
+        for 0"""
         self.log.debug("Executing [reload]")
         connect = self.ssh()
-        output = connect.send_command_timing("reload in 5")
+        output = connect.send_command_timing(reload_command(minutes))
         if "?" in output:
             output += connect.send_command_timing("y")
         self.log.debug("[reload] complete")
         return True
+
+
+class HostRecord:
+    """A switch waiting for a later phase. Holds only what the copy, upgrade
+    and reload phases need, so the Switch, its connection and its facts can
+    go once its audit is done. settings is shared by every record of a run:
+    the Switch class and the keyword arguments to make one with"""
+
+    __slots__ = ("host", "type", "upgradefile", "image_path", "next_version",
+                 "upgrade_md5", "settings")
+
+    def __init__(self, switch, settings):
+        self.host = switch.host
+        self.type = switch.type
+        self.upgradefile = switch.upgradefile
+        self.image_path = switch.image_path
+        self.next_version = switch.next_version
+        self.upgrade_md5 = switch.upgrade_md5
+        self.settings = settings
+
+    @property
+    def username(self):
+        return self.settings[1]["username"]
+
+    @property
+    def password(self):
+        return self.settings[1]["password"]
+
+    @property
+    def port(self):
+        return self.settings[1].get("port", 22)
+
+    def switch(self):
+        """Returns a new Switch for the host, with no facts and no connection
+        until a phase uses it"""
+        cls, options = self.settings
+        switch = cls(self.host, type=self.type, **options)
+        for key in ("upgradefile", "image_path", "next_version",
+                    "upgrade_md5"):
+            setattr(switch, key, getattr(self, key))
+        return switch
@@ -0,0 +1,280 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Dedicated parsers for the cisco_ios commands this tool reads on every
+switch. They give the same result as the ntc-templates TextFSM templates
+netmiko uses, without loading a template on every call. Other platforms and
+commands still go through TextFSM. Run this file to compare the two
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+# show version, following cisco_ios_show_version.textfsm. Each rule is the
+# regex, whether to carry on with the next rule and the state to move to
+_VERSION_FIELDS = [
+    "software_image", "version", "release", "rommon", "hostname", "uptime",
+    "uptime_years", "uptime_weeks", "uptime_days", "uptime_hours",
+    "uptime_minutes", "reload_reason", "running_image", "hardware", "serial",
+    "config_register", "mac_address", "restarted"
+]
+_VERSION_LISTS = {"hardware", "serial", "mac_address"}
+_software = (r"^.*Software,*\s+\((?P<software_image>\S+)\),\sVersion\s"
+             r"(?P<version>.+?),")
+_mac = (r"^Base\s+[Ee]thernet\s+MAC\s+[Aa]ddress\s+:\s+"
+        r"(?P<mac_address>[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5})")
+_VERSION_STATES = {
+    "Start": [
+        (_software + r"*\s+RELEASE.*\((?P<release>\S+)\)", False, None),
+        (_software + r"*\s+\S+.*:(?P<release>\S+)", False, None),
+        (_software, False, None),
+        (r"^ROM:\s+(?P<rommon>\S+)", False, None),
+        (r"^\s*(?P<hostname>\S+)\s+uptime\s+is\s+(?P<uptime>.+)", True,
+         None),
+        (r"^.*\s+uptime\s+is.*\s+(?P<uptime_years>\d+)\syear", True, None),
+        (r"^.*\s+uptime\s+is.*\s+(?P<uptime_weeks>\d+)\sweek", True, None),
+        (r"^.*\s+uptime\s+is.*\s+(?P<uptime_days>\d+)\sday", True, None),
+        (r"^.*\s+uptime\s+is.*\s+(?P<uptime_hours>\d+)\shour", True, None),
+        (r"^.*\s+uptime\s+is.*\s+(?P<uptime_minutes>\d+)\sminute", False,
+         None),
+        (r'^[sS]ystem\s+image\s+file\s+is\s+"(.*?):(?P<running_image>\S+)"',
+         False, None),
+        (r"^(?:[lL]ast\s+reload\s+reason:|System\s+returned\s+to\s+ROM\s+"
+         r"by)\s+(?P<reload_reason>.+?)\s*$", False, None),
+        (r"^[Pp]rocessor\s+board\s+ID\s+(?P<serial>\w+)", False, None),
+        (r"^[Cc]isco\s+(?P<hardware>\S+|\S+\d\S+)\s+\(.+\).+", False, None),
+        (r"^[Cc]onfiguration\s+register\s+is\s+(?P<config_register>\S+)",
+         False, None),
+        (_mac, False, None),
+        (r"^System\s+restarted\s+at\s+(?P<restarted>.+)$", False, None),
+        (r"^Switch\s+Port", False, "Stack"),
+        (r"^Switch\s\d+", False, "Stack"),
+        (r"^Load\s+for\s+", False, None),
+        (r"^Time\s+source\s+is", False, None),
+    ],
+    "Stack": [
+        (r"^[Ss]ystem\s+[Ss]erial\s+[Nn]umber\s+:\s+(?P<serial>\w+)", False,
+         None),
+        (r"^[Mm]odel\s+[Nn]umber\s+:\s+(?P<hardware>\S+|\S+\d\S+)\s*",
+         False, None),
+        (r"^[Cc]onfiguration\s+register\s+is\s+(?P<config_register>\S+)",
+         False, None),
+        (r"^Base [Ee]thernet MAC [Aa]ddress\s+:\s+"
+         r"(?P<mac_address>[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5})", False, None),
+    ],
+}
+_VERSION_STATES = {
+    state: [(re.compile(regex), carry_on, new_state)
+            for regex, carry_on, new_state in rules]
+    for state, rules in _VERSION_STATES.items()
+}
+
+# dir, following cisco_ios_dir.textfsm
+_DIR_FIELDS = [
+    "file_system", "id", "permissions", "size", "total_size", "total_free",
+    "date_time", "name"
+]
+_dir_entry = re.compile(r"^\s*(?P<id>\d+)\s+(?P<permissions>.+?)\s+"
+                        r"(?P<size>\d+)\s+(?P<date_time>.+?)\s+"
+                        r"(?P<name>\S+)\s*$")
+_dir_of = re.compile(r"^Directory of\s+(?P<file_system>\S+)")
+_dir_total = re.compile(r"^(?P<total_size>\d+)\s+\S+\s+\S+\s\("
+                        r"(?P<total_free>\d+) bytes free\)")
+_dir_ignore = re.compile(r"^Load\s+for\s+|^Time\s+source\s+is")
+_dir_empty = re.compile(r"^No\s+files\s+in\s+directory")
+
+
+def show_version(output):
+    """Parses show version. Returns a list holding one dict, or an empty
+    list if nothing matched"""
+    values = {
+        field: [] if field in _VERSION_LISTS else None
+        for field in _VERSION_FIELDS
+    }
+    rules = _VERSION_STATES["Start"]
+    for line in output.splitlines():
+        for regex, carry_on, new_state in rules:
+            match = regex.match(line)
+            if not match:
+                continue
+            for field, value in match.groupdict().items():
+                if field in _VERSION_LISTS:
+                    values[field].append(value)
+                else:
+                    values[field] = value
+            if not carry_on:
+                if new_state:
+                    rules = _VERSION_STATES[new_state]
+                break
+    if not any(values.values()):
+        return []
+    return [{
+        field: "" if value is None else value
+        for field, value in values.items()
+    }]
+
+
+def dir_listing(output):
+    """Parses dir output, including dir /recursive. Returns a dict per file
+    or directory"""
+    results = []
+    values = dict.fromkeys(_DIR_FIELDS)
+    empty = False
+
+    def total(match):
+        # The totals are copied up to every earlier entry without them
+        for field, value in match.groupdict().items():
+            values[field] = value
+            for result in reversed(results):
+                if result[field]:
+                    break
+                result[field] = value
+
+    def record():
+        if not any(values.values()):
+            return
+        results.append({
+            field: "" if value is None else value
+            for field, value in values.items()
+        })
+        # The file system is kept for the entries that follow
+        values.update(dict.fromkeys(_DIR_FIELDS[1:]))
+
+    for line in output.splitlines():
+        if empty:
+            # As in the template, an empty directory ends the listing
+            match = _dir_total.match(line)
+            if match:
+                total(match)
+                record()
+            continue
+        match = _dir_entry.match(line)
+        if match:
+            values.update(match.groupdict())
+            record()
+            continue
+        match = _dir_of.match(line)
+        if match:
+            values["file_system"] = match.group("file_system")
+            continue
+        match = _dir_total.match(line)
+        if match:
+            total(match)
+            continue
+        if _dir_ignore.match(line):
+            continue
+        if _dir_empty.match(line):
+            empty = True
+    return results
+
+
+# show ver, sh version and so on, as matched by the ntc-templates index
+_show_version = re.compile(r"sh(o(w)?)?\s+ver(s(i(o(n)?)?)?)?(\s|$)")
+
+_PARSERS = {"show version": show_version, "dir": dir_listing}
+
+
+def _command(command):
+    """Returns the name of the parser for a command, or None"""
+    command = command.strip()
+    if _show_version.match(command):
+        return "show version"
+    if command.startswith("dir"):
+        return "dir"
+    return None
+
+
+def parse(output, platform, command):
+    """Parses command output like get_structured_data does with TextFSM,
+    using a dedicated parser if there is one. Returns the raw output if
+    nothing could be parsed"""
+    name = _command(command) if platform == "cisco_ios" else None
+    if name is None:
+        # TextFSM comes with netmiko, which is slow to load
+        from netmiko.utilities import get_structured_data
+        return get_structured_data(output, platform=platform, command=command)
+    return _PARSERS[name](output) or output
+
+
+# Samples of real switch output, which the simulator does not copy in
+# every detail, such as a stack, older dates and the exec timestamp lines
+_CAPTURED = [
+    ("show version", "show_version.txt"),
+    ("show version", "show_version_stack.txt"),
+    ("dir flash:", "dir.txt"),
+    ("dir flash:", "dir_old.txt"),
+    ("dir /recursive flash:", "dir_recursive.txt"),
+]
+
+
+def _samples():
+    """Returns sample outputs of every parsed command, of real switches and
+    from the simulator"""
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "samples")
+    samples = []
+    for command, name in _CAPTURED:
+        with open(os.path.join(folder, name)) as sample:
+            samples.append((command, sample.read()))
+    from simfleet import SimSwitch, _entries, _listing
+    from simfleet import show_version as sim_version
+    for members in (1, 2, 4):
+        switch = SimSwitch(f"SW{members}", members=members)
+        switch.files["/html/index.htm"] = (1024, "0" * 32)
+        switch.dirs.add("/empty")
+        samples.append(("show ver", "\n".join(sim_version(switch))))
+        samples.append(("dir", "\n".join(
+            _listing(switch, "/", _entries(switch, "/")))))
+        recursive = []
+        for directory in ["/"] + sorted(switch.dirs):
+            entries = _entries(switch, directory)
+            if entries:
+                recursive += _listing(switch, directory, entries)
+            else:
+                recursive += [
+                    f"Directory of flash:{directory}/", "",
+                    "No files in directory", ""
+                ]
+        samples.append(("dir /recursive flash:", "\n".join(recursive)))
+    return samples
+
+
+def main():
+    """Checks the dedicated parsers give the same result as TextFSM, and
+    times both"""
+    from netmiko.utilities import get_structured_data
+    parser = argparse.ArgumentParser(
+        description="dedicated parsers against TextFSM")
+    parser.add_argument("--runs",
+                        help="Times to parse each sample",
+                        type=int,
+                        default=200)
+    args = parser.parse_args()
+    samples = _samples()
+    for number, (command, output) in enumerate(samples, 1):
+        expected = get_structured_data(output,
+                                       platform="cisco_ios",
+                                       command=command)
+        if parse(output, "cisco_ios", command) != expected:
+            print(f"MISMATCH - {command}", f"(sample {number})")
+            return False
+    for name, run in (("textfsm", get_structured_data), ("dedicated",
+                                                         parse)):
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            for command, output in samples:
+                run(output, platform="cisco_ios", command=command)
+        seconds = time.perf_counter() - start
+        calls = args.runs * len(samples)
+        print(f"{name:>9}: {1000000 * seconds / calls:8.1f} us/call, "
+              f"{calls / seconds:8.0f} calls/s")
+    return True
+
+
+if __name__ == "__main__":
+    # A mismatch fails the check, so it can gate a merge
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,181 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A scheduler that reloads switches in waves. Limits how many switches are
+down at once, overall and per site, and waits for every switch in a wave to
+come back on its new version before starting the next
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import site_of
+
+
+class ReloadScheduler:
+    """Reloads at most wave_size switches at once, and at most per_site from
+    any one site. A site is the subnet of the switch address with the given
+    prefix length, unless names gives the host a named site. tiers is a list
+    of sets of hosts, such as uplinks, that are only reloaded after every
+    switch in an earlier tier is back. Hosts not in any tier go first. delay
+    is the minutes passed to reload in. Each switch is polled every interval
+    seconds, for up to timeout seconds after its reload is due, until it
+    reports its next_version. No further waves are started once more than
+    max_failures switches have not come back"""
+
+    def __init__(self,
+                 log,
+                 wave_size=1,
+                 per_site=0,
+                 prefix=24,
+                 tiers=None,
+                 delay=5,
+                 interval=30,
+                 timeout=1800,
+                 max_failures=0,
+                 names=None):
+        self.log = log
+        self.wave_size = max(1, wave_size)
+        self.per_site = per_site
+        self.prefix = prefix
+        self.names = {} if names is None else names
+        self.tiers = tiers or []
+        self.delay = delay
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.failed = 0
+
+    def site(self, host):
+        """Returns the site a host belongs to"""
+        return site_of(host, self.prefix, self.names)
+
+    def tier(self, host):
+        """Returns the tier a host is reloaded in"""
+        for index, hosts in enumerate(self.tiers, 1):
+            if host in hosts:
+                return index
+        return 0
+
+    def waves(self, switches):
+        """Splits switches into waves, keeping their order within a tier. A
+        switch that would break a site limit waits for a later wave"""
+        waves = []
+        for tier in sorted({self.tier(switch.host) for switch in switches}):
+            pending = [sw for sw in switches if self.tier(sw.host) == tier]
+            while pending:
+                wave, sites, deferred = [], {}, []
+                for switch in pending:
+                    site = self.site(switch.host)
+                    if len(wave) < self.wave_size and (
+                            not self.per_site
+                            or sites.get(site, 0) < self.per_site):
+                        wave.append(switch)
+                        sites[site] = sites.get(site, 0) + 1
+                    else:
+                        deferred.append(switch)
+                waves.append(wave)
+                pending = deferred
+        return waves
+
+    async def wait(self, switch):
+        """Polls a reloaded switch until it answers on its next_version.
+        Returns False if it is not back within the timeout"""
+        from asyncdevices import CONNECT_ERRORS, AsyncSwitch
+        probe = AsyncSwitch(switch.host,
+                            switch.username,
+                            switch.password,
+                            switch.type,
+                            timeout=self.interval,
+                            port=switch.port)
+        await asyncio.sleep(self.delay * 60)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            probe.allfacts = {}
+            try:
+                if await probe.facts() and probe.version(
+                ) == switch.next_version:
+                    self.log.success(f"{switch.host} - Back on "
+                                     f"{switch.next_version}")
+                    return True
+            # Down, still booting or not answering show ver in full yet
+            except (*CONNECT_ERRORS, IndexError, KeyError):
+                pass
+            finally:
+                await probe.close()
+            if time.monotonic() >= deadline:
+                self.log.error(f"{switch.host} - Not back on "
+                               f"{switch.next_version} after reload")
+                return False
+            await asyncio.sleep(self.interval)
+
+    async def wait_all(self, wave):
+        """Waits for every switch in a wave. Returns a result per switch"""
+        return await asyncio.gather(*(self.wait(switch) for switch in wave))
+
+    def _start(self, number, waves, wave):
+        """Logs the start of a wave. Returns False if the run has had too
+        many failures to go on"""
+        if self.failed > self.max_failures:
+            remaining = sum(len(w) for w in waves[number - 1:])
+            self.log.error(
+                f"Stopping reloads, {self.failed} switches did not come back",
+                f"{remaining} switches not reloaded")
+            return False
+        self.log.info(f"Reload wave {number} of {len(waves)}",
+                      ", ".join(switch.host for switch in wave))
+        return True
+
+    def _send(self, reload, switch):
+        """Calls reload for a switch. An error only fails that switch"""
+        try:
+            return reload(switch)
+        except Exception as e:
+            self.log.error(f"{switch.host} - Reload failed", str(e))
+            return False
+
+    def _finish(self, sent, back):
+        """Counts the failures in a wave. back holds a result for every
+        switch that was sent the reload. Returns a result per switch"""
+        back = iter(back)
+        results = [bool(ok and next(back)) for ok in sent]
+        self.failed += results.count(False)
+        return results
+
+    def run(self, reload, switches):
+        """Calls reload for every switch, a wave at a time on a pool of
+        workers, and waits for each wave to come back. Returns True for
+        every switch that is back on its next version, in the same order as
+        switches. Switches in waves that were never started are False"""
+        results = {}
+        waves = self.waves(switches)
+        for number, wave in enumerate(waves, 1):
+            if not self._start(number, waves, wave):
+                break
+            with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+                sent = list(
+                    pool.map(lambda sw: self._send(reload, sw), wave))
+            back = asyncio.run(
+                self.wait_all([sw for sw, ok in zip(wave, sent) if ok]))
+            results.update(zip(wave, self._finish(sent, back)))
+        return [results.get(switch, False) for switch in switches]
+
+    async def run_async(self, reload, switches):
+        """Async variant of run, where reload is a coroutine function"""
+        results = {}
+        waves = self.waves(switches)
+        for number, wave in enumerate(waves, 1):
+            if not self._start(number, waves, wave):
+                break
+            sent = await asyncio.gather(*(reload(switch) for switch in wave),
+                                        return_exceptions=True)
+            for switch, ok in zip(wave, sent):
+                if isinstance(ok, Exception):
+                    self.log.error(f"{switch.host} - Reload failed", str(ok))
+            sent = [ok is True for ok in sent]
+            back = await self.wait_all(
+                [sw for sw, ok in zip(wave, sent) if ok])
+            results.update(zip(wave, self._finish(sent, back)))
+        return [results.get(switch, False) for switch in switches]
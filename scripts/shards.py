@@ -0,0 +1,216 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Splits a host list into shards by site or subnet and hands them to worker
+instances of swupgrade.py, so a rollout can be spread over several jump
+hosts. Coordinator and workers talk JSON lines over TCP. A worker asks for a
+shard, runs the phases on it and sends back the result of every phase for
+every host. Shards whose worker fails or goes away are handed out again. No
+passwords are sent, each worker logs in with its own
+"""
+
+import json
+import socket
+import socketserver
+import subprocess
+import threading
+from collections import deque
+
+from inventory import site_of
+
+
+def split(hosts, sites=None, prefix=24, size=0):
+    """Returns hosts as a list of shards. Hosts are grouped by their site in
+    sites, otherwise by their subnet with the given prefix length. Hostnames
+    without a site share a shard. With size, no shard holds more than size
+    hosts"""
+    groups = {}
+    for host in hosts:
+        site = site_of(host, prefix, sites)
+        # Rather than a shard of one for each hostname
+        groups.setdefault("" if site == host else site, []).append(host)
+    shards = []
+    for group in groups.values():
+        step = size or len(group)
+        shards += [group[i:i + step] for i in range(0, len(group), step)]
+    return shards
+
+
+def parse_address(text, port=0):
+    """Returns (address, port) from ADDRESS:PORT, or ADDRESS alone"""
+    address, sep, number = text.rpartition(":")
+    if not sep:
+        return text, port
+    return address.strip("[]") or "127.0.0.1", int(number)
+
+
+def _send(stream, message):
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def _receive(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+
+def _subset(mapping, hosts):
+    return {host: mapping[host] for host in hosts if host in mapping}
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        with self.request.makefile("rw", encoding="utf-8") as stream:
+            self.server.coordinator.serve(stream, self.client_address[0])
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Coordinator:
+    """Hands shards out to the workers that connect, one at a time each, and
+    merges what they send back. options are sent with every shard, for the
+    workers to run it with. A shard is handed out again if its worker
+    reports an error or disconnects, up to retries times. types and sites
+    map a host to its device type and site"""
+
+    def __init__(self,
+                 shards,
+                 options,
+                 log,
+                 address=("127.0.0.1", 0),
+                 retries=2,
+                 types=None,
+                 sites=None):
+        self.shards = shards
+        self.options = options
+        self.log = log
+        self.retries = retries
+        self.types = types or {}
+        self.sites = sites or {}
+        self.pending = deque(range(len(shards)))
+        self.attempts = [0] * len(shards)
+        self.active = 0
+        self.results = {}
+        self.failed = []
+        self.cond = threading.Condition()
+        self.server = _Server(address, _Handler)
+        self.server.coordinator = self
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def take(self):
+        """Returns the next shard to hand out, waiting while shards that may
+        come back are out with workers. Returns None when there are none
+        left"""
+        with self.cond:
+            while not self.pending and self.active:
+                self.cond.wait()
+            if not self.pending:
+                return None
+            self.active += 1
+            return self.pending.popleft()
+
+    def finish(self, shard, results=None, error=None):
+        """Records the results of a shard, or hands it out again"""
+        with self.cond:
+            self.active -= 1
+            self.attempts[shard] += 1
+            if error is None:
+                for host, phase, ok in results:
+                    self.results.setdefault(host, {})[phase] = ok
+            elif self.attempts[shard] <= self.retries:
+                self.log.error(f"Shard {shard} failed, queued again", error)
+                self.pending.append(shard)
+            else:
+                self.log.error(f"Shard {shard} failed, giving up", error)
+                self.failed.append(shard)
+            self.cond.notify_all()
+
+    def serve(self, stream, worker):
+        """Feeds shards to one worker until there are none left"""
+        while True:
+            shard = self.take()
+            if shard is None:
+                try:
+                    _send(stream, {"done": True})
+                except OSError:
+                    pass
+                return
+            hosts = self.shards[shard]
+            self.log.info(f"Shard {shard} - {len(hosts)} hosts", worker)
+            try:
+                _send(
+                    stream, {
+                        "shard": shard,
+                        "hosts": hosts,
+                        "types": _subset(self.types, hosts),
+                        "sites": _subset(self.sites, hosts),
+                        "options": self.options,
+                    })
+                reply = _receive(stream)
+                if reply.get("shard") != shard:
+                    raise ValueError(f"Reply for shard {reply.get('shard')}")
+            except (OSError, ValueError) as e:
+                self.finish(shard, error=str(e))
+                return
+            self.finish(shard, reply.get("results"), reply.get("error"))
+
+    def run(self, commands=None, env=None):
+        """Serves shards until every one has finished. commands are started
+        as local worker processes. Returns results, a dict of host to a
+        dict of phase to ok. If every local worker exits while shards are
+        left, those shards are given up on"""
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        workers = [
+            subprocess.Popen(command, env=env) for command in commands or []
+        ]
+        try:
+            with self.cond:
+                while self.pending or self.active:
+                    self.cond.wait(1)
+                    if workers and all(w.poll() is not None
+                                       for w in workers):
+                        self.failed += self.pending
+                        self.pending.clear()
+                        break
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            for worker in workers:
+                worker.wait()
+        return self.results
+
+
+def work(address, run, log):
+    """Connects to a coordinator and runs every shard it hands out with
+    run(hosts, types, sites, options), which returns a list of (host,
+    phase, ok).
+    Returns the number of shards run"""
+    count = 0
+    with socket.create_connection(address) as connection, connection.makefile(
+            "rw", encoding="utf-8") as stream:
+        while True:
+            message = _receive(stream)
+            if message.get("done"):
+                return count
+            shard = message["shard"]
+            log.info(f"Shard {shard} - {len(message['hosts'])} hosts")
+            try:
+                results = run(message["hosts"], message["types"],
+                              message["sites"], message["options"])
+                reply = {"shard": shard, "results": results}
+            # The coordinator decides whether the shard is tried again
+            except Exception as e:
+                reply = {"shard": shard, "error": f"{type(e).__name__}: {e}"}
+            _send(stream, reply)
+            count += 1
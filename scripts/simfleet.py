@@ -0,0 +1,604 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A simulated fleet of IOS switches for testing and benchmarking without real
+hardware. Every switch is a loopback address served by one local SSH server
+that answers the commands this tool sends, and accepts SCP and HTTP copies
+to a virtual flash
+"""
+
+import asyncio
+import hashlib
+import http.client
+import ipaddress
+import posixpath
+import random
+import re
+import shlex
+import threading
+import time
+import urllib.parse
+
+import asyncssh
+
+_copy = re.compile(r"^copy\s+(\S+)\s+(\S+)$")
+_reload = re.compile(r"^reload(?:\s+in\s+(\d+))?$")
+_image = re.compile(r"mz\.(\d+)(\d)-(\d+)\.(\w+)\.bin$")
+_date = "Mar 1 1993 00:11:42 +00:00"
+_invalid = "% Invalid input detected at '^' marker."
+
+
+def image_version(image):
+    """Returns the IOS version of an image file name, so
+    c2960x-universalk9-mz.152-7.E2.bin gives 15.2(7)E2"""
+    match = _image.search(image)
+    if not match:
+        return "15.2(4)E8"
+    major, minor, release, build = match.groups()
+    return f"{major}.{minor}({release}){build}"
+
+
+def _fake_md5(path, size):
+    """An MD5 for files that exist on the simulated flash from the start"""
+    return hashlib.md5(f"{path}:{size}".encode()).hexdigest()
+
+
+class SimSwitch:
+    """The state of one simulated switch. latency and jitter are seconds
+    added to every login and command. failure_rate is the chance a login is
+    dropped, transfer_failure_rate the chance a copy drops half way.
+    bandwidth caps copies to the switch in bytes per second. A reload takes
+    boot_time seconds, and reload in N waits N minutes times time_scale"""
+
+    def __init__(self,
+                 hostname,
+                 model="WS-C2960X-48FPD-L",
+                 image="c2960x-universalk9-mz.152-4.E8.bin",
+                 files=None,
+                 flash_size=122185728,
+                 members=1,
+                 latency=0.0,
+                 jitter=0.0,
+                 failure_rate=0.0,
+                 transfer_failure_rate=0.0,
+                 bandwidth=0,
+                 boot_time=0.0,
+                 time_scale=1.0):
+        self.hostname = hostname
+        self.model = model
+        self.flash_size = flash_size
+        self.members = members
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.transfer_failure_rate = transfer_failure_rate
+        self.bandwidth = bandwidth
+        self.boot_time = boot_time
+        self.time_scale = time_scale
+        self.running = f"/{image}"
+        self.boot = self.running
+        self.config = ["hostname " + hostname, "ip scp server enable"]
+        self.dirs = {"/html"}
+        self.files = {}
+        defaults = {
+            self.running: 26476544,
+            "/config.text": 3985,
+            "/vlan.dat": 736,
+            "/html/home.htm": 6452,
+        }
+        for path, size in dict(defaults, **(files or {})).items():
+            self.files[path] = (size, _fake_md5(path, size))
+        self.serials = [
+            f"FOC{random.randrange(16**7):07X}" for _ in range(members)
+        ]
+        self.booted = time.time()
+        self.reload_at = None
+        self.saved = True
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Returns the seconds to wait before answering"""
+        return self.latency + random.uniform(0, self.jitter)
+
+    def fails(self, rate):
+        return rate > 0 and random.random() < rate
+
+    def up(self):
+        """Returns False while the switch is reloading. A reload finishes on
+        the first check after it is due"""
+        with self.lock:
+            if self.reload_at is None or time.time() < self.reload_at:
+                return True
+            if time.time() < self.reload_at + self.boot_time:
+                return False
+            self.running = self.boot
+            self.reload_at = None
+            self.booted = time.time()
+            return True
+
+    def version(self):
+        return image_version(self.running)
+
+    def used(self):
+        return sum(size for size, _ in self.files.values())
+
+    def free(self):
+        return self.flash_size - self.used()
+
+    def put(self, path, size, md5):
+        """Writes a file to flash"""
+        with self.lock:
+            self.files[path] = (size, md5)
+
+    def isdir(self, path):
+        return path == "/" or path.rstrip("/") in self.dirs
+
+
+def _flash_path(path):
+    """Returns a flash path in the form /dir/file"""
+    if path.startswith("flash:"):
+        path = path[len("flash:"):]
+    return posixpath.normpath("/" + path.strip("/")) if path else "/"
+
+
+def _listing(switch, directory, entries):
+    lines = [f"Directory of flash:{directory.rstrip('/')}/", ""]
+    for index, (name, size, is_dir) in enumerate(entries, 2):
+        permissions = "drwx" if is_dir else "-rwx"
+        lines.append(f"{index:>5}  {permissions} {size:>12}  {_date}  {name}")
+    return lines + [
+        "", f"{switch.flash_size} bytes total ({switch.free()} bytes free)"
+    ]
+
+
+def _entries(switch, directory):
+    """Returns the name, size and type of everything in a flash directory"""
+    directory = directory.rstrip("/")
+    entries = [(posixpath.basename(d), 512, True) for d in sorted(switch.dirs)
+               if posixpath.dirname(d) == (directory or "/")]
+    entries += [(posixpath.basename(path), size, False)
+                for path, (size, _) in sorted(switch.files.items())
+                if posixpath.dirname(path) == (directory or "/")]
+    return entries
+
+
+def show_version(switch):
+    """Returns the lines of show version"""
+    uptime = int(time.time() - switch.booted) // 60
+    software = f"{switch.model.split('-')[1]}-UNIVERSALK9-M"
+    lines = [
+        f"Cisco IOS Software, {switch.model.split('-')[1]} Software "
+        f"({software}), Version {switch.version()}, RELEASE SOFTWARE (fc3)",
+        "Technical Support: http://www.cisco.com/techsupport",
+        "Copyright (c) 1986-2019 by Cisco Systems, Inc.",
+        "",
+        f"ROM: Bootstrap program is {switch.model.split('-')[1]} boot loader",
+        "",
+        f"{switch.hostname} uptime is {uptime // 1440} days, "
+        f"{uptime // 60 % 24} hours, {uptime % 60} minutes",
+        "System returned to ROM by power-on",
+        f'System image file is "flash:{switch.running}"',
+        "",
+        f"cisco {switch.model} (APM86XXX) processor (revision A0) with "
+        "524288K bytes of memory.",
+        f"Processor board ID {switch.serials[0]}",
+        "",
+        "Base Ethernet MAC Address       : 00:11:22:33:44:55",
+        f"Model number                    : {switch.model}",
+        f"System serial number            : {switch.serials[0]}",
+        "",
+        "Switch Ports Model                     SW Version            "
+        "SW Image",
+        "------ ----- -----                     ----------            "
+        "----------",
+    ]
+    for member in range(switch.members):
+        lines.append(f"{'*' if member == 0 else ' '}    {member + 1} 52    "
+                     f"{switch.model:<25} {switch.version():<21} {software}")
+    for member, serial in enumerate(switch.serials[1:], 2):
+        lines += [
+            "", f"Switch {member:02d}", "---------",
+            f"Model number                    : {switch.model}",
+            f"System serial number            : {serial}"
+        ]
+    lines += ["", "Configuration register is 0xF", ""]
+    return lines
+
+
+class _Session:
+    """One CLI session on a switch. Tracks the mode and any question the
+    switch is waiting for an answer to"""
+
+    def __init__(self, switch, host):
+        self.switch = switch
+        self.host = host
+        self.config = False
+        self.pending = None
+        self.closed = False
+
+    def prompt(self):
+        if self.pending:
+            return ""
+        mode = "(config)" if self.config else ""
+        return f"{self.switch.hostname}{mode}#"
+
+    async def execute(self, line):
+        """Runs one line of input and returns the output"""
+        await asyncio.sleep(self.switch.delay())
+        if self.pending:
+            answer, self.pending = self.pending, None
+            return await answer(line)
+        if not line:
+            return ""
+        if self.config:
+            return self.configure(line)
+        return await self.exec(line)
+
+    def configure(self, line):
+        switch = self.switch
+        if line in ("end", "exit"):
+            self.config = False
+        elif line.startswith("boot system "):
+            switch.boot = _flash_path(line.split()[-1])
+            switch.saved = False
+        elif line == "no boot system":
+            switch.boot = switch.running
+        elif line.startswith("do "):
+            return _invalid
+        else:
+            switch.config.append(line)
+            switch.saved = False
+        return ""
+
+    async def exec(self, line):
+        switch = self.switch
+        words = line.split()
+        if line in ("exit", "logout", "quit"):
+            self.closed = True
+            return ""
+        if line.startswith("terminal "):
+            return ""
+        if line in ("configure terminal", "conf t"):
+            self.config = True
+            return ("Enter configuration commands, one per line.  "
+                    "End with CNTL/Z.")
+        if line.startswith("show ver"):
+            return "\n".join(show_version(switch))
+        if line.startswith("show boot"):
+            return f"BOOT path-list      : flash:{switch.boot}"
+        if line.startswith("show run"):
+            return "\n".join(["Building configuration...", "",
+                              "Current configuration : 1024 bytes", "!"] +
+                             switch.config + [f"boot system flash:"
+                                              f"{switch.boot}", "end"])
+        if line in ("wr mem", "write memory", "copy run start"):
+            switch.saved = True
+            return "Building configuration...\n[OK]"
+        if words[0] == "dir":
+            return self.dir(words[1:])
+        if words[:2] == ["verify", "/md5"] and len(words) == 3:
+            return self.verify(_flash_path(words[2]))
+        if words[0] == "delete":
+            with switch.lock:
+                switch.files.pop(_flash_path(words[-1]), None)
+            return ""
+        match = _copy.match(line)
+        if match:
+            return self.copy(*match.groups())
+        match = _reload.match(line)
+        if match:
+            minutes = int(match.group(1) or 0)
+            self.pending = lambda answer: self.reload(minutes)
+            return (f"Reload scheduled in {minutes} minutes by admin\n"
+                    "Proceed with reload? [confirm]")
+        return _invalid
+
+    def dir(self, args):
+        switch = self.switch
+        recursive = "/recursive" in args
+        args = [arg for arg in args if not arg.startswith("/")]
+        path = _flash_path(args[0]) if args else "/"
+        if path in switch.files:
+            size, _ = switch.files[path]
+            return "\n".join(
+                _listing(switch, posixpath.dirname(path),
+                         [(posixpath.basename(path), size, False)]))
+        if not switch.isdir(path):
+            return f"%Error opening flash:{path} (No such file or directory)"
+        directories = [path]
+        if recursive:
+            directories += sorted(d for d in switch.dirs
+                                  if d.startswith(path.rstrip("/") + "/"))
+        lines = []
+        for directory in directories:
+            lines += _listing(switch, directory,
+                              _entries(switch, directory))[:-2]
+            lines.append("")
+        return "\n".join(lines + _listing(switch, path, [])[-1:])
+
+    def verify(self, path):
+        if path not in self.switch.files:
+            return f"%Error opening flash:{path} (No such file or directory)"
+        md5 = self.switch.files[path][1]
+        return f"{'.' * 40}Done!\nverify /md5 (flash:{path}) = {md5}"
+
+    def copy(self, source, destination):
+        name = posixpath.basename(urllib.parse.urlparse(source).path)
+        path = _flash_path(destination)
+        if self.switch.isdir(path):
+            path = posixpath.join(path, name)
+
+        async def answer(line):
+            return await self.download(source, path)
+
+        self.pending = answer
+        return f"Destination filename [{path.lstrip('/')}]? "
+
+    async def download(self, url, path):
+        """Copies a file from an HTTP server to flash, as the switch itself
+        would. The request is made from the switch's own address"""
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            size, md5 = await loop.run_in_executor(None, self.fetch, url)
+        except (OSError, http.client.HTTPException):
+            return f"%Error opening {url} (No such file or directory)"
+        if size is None:
+            return f"%Error reading {url} (I/O error)"
+        self.switch.put(path, size, md5)
+        elapsed = max(time.monotonic() - start, 0.001)
+        return (f"Accessing {url}...\nLoading {path.lstrip('/')} !!!!\n"
+                f"[OK - {size}/4096 bytes]\n\n{size} bytes copied in "
+                f"{elapsed:.3f} secs ({int(size / elapsed)} bytes/sec)")
+
+    def fetch(self, url):
+        """Downloads url and returns its size and MD5, or None for the size
+        if the transfer was dropped"""
+        switch = self.switch
+        parts = urllib.parse.urlparse(url)
+        connection = http.client.HTTPConnection(parts.hostname,
+                                                parts.port or 80,
+                                                timeout=60,
+                                                source_address=(self.host, 0))
+        try:
+            connection.request("GET", parts.path)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise OSError(response.status)
+            total = int(response.getheader("Content-Length", 0))
+            drop = total // 2 if switch.fails(
+                switch.transfer_failure_rate) else None
+            md5 = hashlib.md5()
+            size = 0
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                if drop is not None and size + len(chunk) > drop:
+                    return None, None
+                md5.update(chunk)
+                size += len(chunk)
+                if switch.bandwidth:
+                    time.sleep(len(chunk) / switch.bandwidth)
+            return size, md5.hexdigest()
+        finally:
+            connection.close()
+
+    async def reload(self, minutes):
+        switch = self.switch
+        with switch.lock:
+            switch.reload_at = time.time() + minutes * 60 * switch.time_scale
+        return ""
+
+
+class _SimServer(asyncssh.SSHServer):
+    """Accepts logins for the switch at the local address connected to"""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.switch = None
+
+    def connection_made(self, conn):
+        peer = conn.get_extra_info("peername")[0]
+        host = conn.get_extra_info("sockname")[0]
+        self.switch = self.fleet.switches.get(host)
+        self.fleet.connections.add(conn)
+        self.conn = conn
+        if (self.switch is None or not self.switch.up()
+                or not ipaddress.ip_address(peer).is_loopback
+                or self.switch.fails(self.switch.failure_rate)):
+            conn.abort()
+
+    def connection_lost(self, exc):
+        self.fleet.connections.discard(self.conn)
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    async def validate_password(self, username, password):
+        await asyncio.sleep(self.switch.delay())
+        return (username == self.fleet.username
+                and password == self.fleet.password)
+
+
+class SimFleet:
+    """Runs an SSH server for a fleet of simulated switches on a background
+    thread. Switches are added by loopback address, and every address in
+    127.0.0.0/8 reaches the same server, so this needs Linux. The server
+    listens on every interface on port, but only accepts local clients.
+    settings are the defaults for every SimSwitch added"""
+
+    def __init__(self, port=0, username="admin", password="admin",
+                 **settings):
+        self.port = port
+        self.username = username
+        self.password = password
+        self.settings = settings
+        self.switches = {}
+        self.connections = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def add(self, host, **settings):
+        """Adds a switch at a loopback address and returns it"""
+        count = len(self.switches) + 1
+        switch = SimSwitch(**{
+            "hostname": f"SIM-{count:05d}",
+            **self.settings,
+            **settings
+        })
+        self.switches[host] = switch
+        return switch
+
+    def populate(self, count, network="127.1.0.0/16", **settings):
+        """Adds count switches with addresses from network. Returns their
+        addresses"""
+        hosts = []
+        for address in ipaddress.ip_network(network).hosts():
+            if len(hosts) == count:
+                break
+            if str(address) not in self.switches:
+                hosts.append(str(address))
+                self.add(hosts[-1], **settings)
+        return hosts
+
+    async def _listen(self):
+        key = asyncssh.generate_private_key("ssh-ed25519")
+        self.server = await asyncssh.create_server(
+            lambda: _SimServer(self),
+            "0.0.0.0",
+            self.port,
+            server_host_keys=[key],
+            process_factory=self._session,
+            encoding=None,
+            line_editor=False,
+            backlog=1024,
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Starts the server in the background"""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._listen(), self.loop).result()
+        return self
+
+    def stop(self):
+        """Stops the server"""
+
+        async def close():
+            self.server.close()
+            for conn in list(self.connections):
+                conn.abort()
+            await self.server.wait_closed()
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        return True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    async def _session(self, process):
+        host = process.get_extra_info("sockname")[0]
+        switch = self.switches[host]
+        try:
+            if process.command and process.command.startswith("scp "):
+                await self._scp(process, switch,
+                                shlex.split(process.command)[-1])
+            elif process.command:
+                session = _Session(switch, host)
+                output = await session.execute(process.command.strip())
+                process.stdout.write(output.encode() + b"\n")
+            else:
+                await self._shell(process, _Session(switch, host))
+        except (asyncssh.Error, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            process.exit(0)
+
+    async def _shell(self, process, session):
+        """Echoes each line of input and answers it, like a terminal"""
+        process.stdout.write(session.prompt().encode())
+        buffer = ""
+        while not session.closed:
+            data = await process.stdin.read(4096)
+            if not data:
+                break
+            # Like IOS, ignore the NULs some clients send as padding
+            buffer += data.decode("utf-8", "replace").replace("\0", "")
+            while not session.closed:
+                match = re.search(r"\r\n|\r(?=.)|\n", buffer, re.S)
+                if not match:
+                    break
+                line, buffer = buffer[:match.start()], buffer[match.end():]
+                process.stdout.write(f"{line}\r\n".encode())
+                output = await session.execute(line.strip())
+                if output and session.pending:
+                    output = output.replace("\n", "\r\n")
+                elif output:
+                    output = output.replace("\n", "\r\n") + "\r\n"
+                process.stdout.write(f"{output}{session.prompt()}".encode())
+
+    async def _scp(self, process, switch, destination):
+        """Receives files with the sink side of the SCP protocol"""
+        stdin, stdout = process.stdin, process.stdout
+        target = _flash_path(destination)
+        stdout.write(b"\0")
+        while True:
+            header = await stdin.readline()
+            if not header or header[:1] == b"E":
+                return
+            if header[:1] == b"T":
+                stdout.write(b"\0")
+                continue
+            if header[:1] != b"C":
+                stdout.write(b"\x01scp: unsupported request\n")
+                return
+            _, size, name = header[1:].decode().rstrip("\n").split(" ", 2)
+            size = int(size)
+            path = target
+            if switch.isdir(target):
+                path = posixpath.join(target, name)
+            if size > switch.free() + switch.files.get(path, (0, ))[0]:
+                stdout.write(f"\x01scp: flash:{path}: No space left on "
+                             "device\n".encode())
+                return
+            drop = size // 2 if switch.fails(
+                switch.transfer_failure_rate) else None
+            stdout.write(b"\0")
+            md5 = hashlib.md5()
+            received = 0
+            while received < size:
+                chunk = await stdin.read(min(64 * 1024, size - received))
+                if not chunk:
+                    break
+                if drop is not None and received + len(chunk) > drop:
+                    switch.put(path, received, md5.hexdigest())
+                    process.channel.abort()
+                    return
+                md5.update(chunk)
+                received += len(chunk)
+                if switch.bandwidth:
+                    await asyncio.sleep(len(chunk) / switch.bandwidth)
+            switch.put(path, received, md5.hexdigest())
+            if received < size:
+                return
+            await stdin.readexactly(1)
+            stdout.write(b"\0")
@@ -7,15 +7,25 @@ A script to upgrade Cisco switch IOS
 
 import argparse
 import getpass
-import ipaddress
 import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import netmiko
-import yaml
-from packaging import version
-
+from backupstore import BackupStore
+from catalog import load_catalog
+from connections import ConnectionPool
+from factcache import FactCache
+from inventory import Inventory
+from journal import Journal
+import logger
 from logger import Logger
+from netdevices import HostRecord
 from netdevices import Switch as s
+from netdevices import InvalidConfigCommand, switch_errors, version_key
+from tracing import Tracer
+from transfers import Checkpoints, TransferScheduler, file_md5, human_size
 
 
 class SwitchNotSupported(Exception):
@@ -29,6 +39,15 @@ class global_arrays(object):
     copy_list = []
     upgrade_list = []
     reload_list = []
+    # The Switch class and options every HostRecord of the run is made with
+    settings = None
+
+    @classmethod
+    def clear(cls):
+        """Empties the lists, ready for another run in the same process"""
+        for hosts in (cls.host_list, cls.copy_list, cls.upgrade_list,
+                      cls.reload_list):
+            hosts.clear()
 
 
 def parse_arguments():
@@ -43,6 +62,9 @@ def parse_arguments():
     host.add_argument("--host", help="switch IP address")
     host.add_argument("--list",
                       help="File containing list of switch IP addresses")
+    host.add_argument("--worker",
+                      help="Run the shards handed out by the coordinator at "
+                      "ADDRESS:PORT")
     parser.add_argument("--user", help="Username to connect", required=True)
     parser.add_argument("--copy",
                         help="Copy upgrade files to devices",
@@ -53,6 +75,133 @@ def parse_arguments():
     parser.add_argument("--reload",
                         help="Reload switches post upgrade",
                         action="store_true")
+    parser.add_argument("--reload-wave",
+                        help="Reload this many switches at a time and wait "
+                        "for each wave to come back on the new version, 0 "
+                        "to reload every switch without waiting",
+                        type=int,
+                        default=0)
+    parser.add_argument("--reload-site",
+                        help="Max switches per site in a reload wave, 0 for "
+                        "no limit",
+                        type=int,
+                        default=0)
+    parser.add_argument("--reload-last",
+                        help="File containing switches, such as uplinks, to "
+                        "reload after all others are back. Can be repeated",
+                        action="append")
+    parser.add_argument("--reload-delay",
+                        help="Minutes passed to reload in, 0 to reload "
+                        "straight away",
+                        type=int,
+                        default=5)
+    parser.add_argument("--reload-timeout",
+                        help="Seconds to wait for a switch to come back "
+                        "after its reload",
+                        type=int,
+                        default=1800)
+    parser.add_argument("--reload-max-failures",
+                        help="Stop starting reload waves once more than "
+                        "this many switches have not come back",
+                        type=int,
+                        default=0)
+    parser.add_argument("--workers",
+                        help="Number of switches to audit in parallel",
+                        type=int,
+                        default=1)
+    parser.add_argument("--batch",
+                        help="Collect switch facts in a single command burst",
+                        action="store_true")
+    parser.add_argument("--site-workers",
+                        help="Max file transfers per site, 0 for no limit",
+                        type=int,
+                        default=0)
+    parser.add_argument("--site-prefix",
+                        help="Prefix length that groups switches into sites",
+                        type=int,
+                        default=24)
+    parser.add_argument("--bandwidth",
+                        help="Total bandwidth cap for file transfers in "
+                        "Mbit/s, 0 for no cap",
+                        type=float,
+                        default=0)
+    parser.add_argument("--serve",
+                        help="Address switches can reach this host on. Images "
+                        "are served over HTTP and pulled by the switches")
+    parser.add_argument("--serve-port",
+                        help="Port for the image server",
+                        type=int,
+                        default=8080)
+    parser.add_argument("--max-sessions",
+                        help="Max SSH sessions open at once, 0 for no limit",
+                        type=int,
+                        default=0)
+    parser.add_argument("--idle-timeout",
+                        help="Seconds before an idle SSH session is closed",
+                        type=int,
+                        default=300)
+    parser.add_argument("--retries",
+                        help="Times to retry a dropped file transfer",
+                        type=int,
+                        default=2)
+    parser.add_argument("--cache-ttl",
+                        help="Reuse cached switch facts up to this many "
+                        "seconds old",
+                        type=int,
+                        default=0)
+    parser.add_argument("--port",
+                        help="SSH port of the switches",
+                        type=int,
+                        default=22)
+    parser.add_argument("--probe-timeout",
+                        help="Seconds to wait for the SSH port of each "
+                        "switch in the pre-flight check, 0 to skip it",
+                        type=float,
+                        default=3)
+    parser.add_argument("--resume",
+                        help="Carry on with the last run, skipping the "
+                        "hosts and phases it already finished",
+                        action="store_true")
+    parser.add_argument("--trace",
+                        help="Write a JSON lines timing trace to this file "
+                        "and print a timing summary")
+    parser.add_argument("--log-format",
+                        help="Write log lines for people or as JSON lines",
+                        choices=["human", "json"],
+                        default="human")
+    parser.add_argument("--log-group",
+                        help="Hold back the log lines of each switch and "
+                        "write them together once its result is known",
+                        action="store_true")
+    parser.add_argument("--summary",
+                        help="Print a table of the info, success and error "
+                        "lines logged for every switch at the end",
+                        action="store_true")
+    parser.add_argument("--coordinate",
+                        help="Split the hosts into shards by site and hand "
+                        "them to workers connecting on ADDRESS:PORT, instead "
+                        "of running the phases here",
+                        nargs="?",
+                        const="127.0.0.1:0")
+    parser.add_argument("--spawn",
+                        help="Number of local workers for the coordinator "
+                        "to start",
+                        type=int,
+                        default=0)
+    parser.add_argument("--shard-size",
+                        help="Most hosts in a shard, 0 for one shard per "
+                        "site",
+                        type=int,
+                        default=0)
+    parser.add_argument("--shard-retries",
+                        help="Times a shard is handed out again after its "
+                        "worker fails",
+                        type=int,
+                        default=2)
+    parser.add_argument("--engine",
+                        help="Connection engine to use",
+                        choices=["netmiko", "async"],
+                        default="netmiko")
     parser.add_argument("--debug", help="Debug logging", action="store_true")
     parser.add_argument("--help",
                         help="Show this help msg and exit",
@@ -60,31 +209,118 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def validate_hosts(args):
-    """Reads in the host or list variable and returns a list of hosts"""
+def validate_hosts(args, inventory=None):
+    """Reads in the host or list variable and returns an iterator over the
+    valid hosts. The list is read as the hosts are used, so work can start
+    on the first hosts of a large list straight away"""
     log = Logger(["VALIDATE HOSTS"], debug_on=args.debug)
-    hosts = []
+    inventory = inventory or Inventory(log)
     if args.host:
-        hosts.append(args.host)
+        return inventory.hosts([args.host])
     elif args.list:
         try:
-            with open(f"../iplists/{args.list}") as f:
-                mylist = f.read().splitlines()
-                for item in mylist:
-                    hosts.append(item)
+            return inventory.load(f"../iplists/{args.list}")
         except FileNotFoundError as e:
             log.error(e)
             quit()
-    for host in hosts:
-        try:
-            ipaddress.ip_address(host)
-            log.debug(f"{host} - Valid IP")
-            global_arrays.host_list.append(host)
-        except ValueError:
-            log.error(f"{host} - INVALID IP")
+    return iter([])
+
+
+# Most TCP probes in flight at once during the pre-flight sweep
+PROBE_CONCURRENCY = 512
+
+
+async def _reachable(host, port, timeout):
+    """Returns True if a TCP connection to host:port opens in time"""
+    import asyncio
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                           timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
     return True
 
 
+async def _sweep(hosts, port, timeout, only, report):
+    """Probes hosts as they are read, at most PROBE_CONCURRENCY at a time,
+    and reports each host with its place in hosts and its result"""
+    import asyncio
+    limit = asyncio.Semaphore(PROBE_CONCURRENCY)
+    tasks = set()
+
+    async def probe(index, host):
+        try:
+            report((index, host, await _reachable(host, port, timeout)))
+        finally:
+            limit.release()
+
+    for index, host in enumerate(hosts):
+        if only is not None and host not in only:
+            report((index, host, True))
+            continue
+        await limit.acquire()
+        task = asyncio.ensure_future(probe(index, host))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+def preflight_hosts(hosts, port=22, timeout=3, only=None):
+    """Probes the SSH port of hosts before any login, many at once and as
+    they are read, on a background thread. Returns an iterator over the
+    hosts that answer within timeout seconds, in the order they were read,
+    so the run does not depend on which switch answers first. The others
+    are reported. If only is given, just those hosts are probed and
+    the rest are passed straight through"""
+    if only is not None and not only:
+        return iter(hosts)
+    results = queue.Queue()
+
+    def sweep():
+        import asyncio
+        try:
+            asyncio.run(_sweep(hosts, port, timeout, only, results.put))
+            results.put(None)
+        # Handed to the reading thread, such as quit() on a bad host list
+        except BaseException as e:
+            results.put(e)
+
+    threading.Thread(target=sweep, daemon=True).start()
+
+    def reachable():
+        # Answers held back until the hosts read before them are done
+        answered = {}
+        following = 0
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            if isinstance(result, BaseException):
+                raise result
+            index, host, up = result
+            answered[index] = (host, up)
+            while following in answered:
+                host, up = answered.pop(following)
+                following += 1
+                if up:
+                    yield host
+                    continue
+                print_result(
+                    host=host,
+                    status="error",
+                    info="Unreachable",
+                    msg=f"No answer on TCP/{port} within {timeout}s",
+                    msg_color="red",
+                )
+
+    return reachable()
+
+
 def supported_switch(s):
     """Identify if the switch is supported by this upgrade process"""
     if s.ios_xe():
@@ -96,11 +332,10 @@ def supported_switch(s):
     return True
 
 
-def yaml_loader(filepath, log):
-    """Load a yaml file"""
+def catalog_loader(filepath, log):
+    """Load the compiled catalog of an images file"""
     try:
-        with open(filepath, "r") as myfile:
-            return yaml.load(myfile, Loader=yaml.BaseLoader)
+        return load_catalog(filepath)
     except FileNotFoundError as e:
         log.error(e)
         quit()
@@ -108,7 +343,7 @@ def yaml_loader(filepath, log):
 
 def print_result(host, status, info, msg, msg_color):
     """print the information from check_upgrade to the user"""
-    s_log = Logger(host)
+    s_log = Logger(host, host=host)
     if status == "error":
         s_log.error(info, msg, msg_color)
     elif status == "info":
@@ -117,23 +352,56 @@ def print_result(host, status, info, msg, msg_color):
         s_log.success(info, msg, msg_color)
     else:
         s_log.error("Something went wrong")
+    # The result closes the block of lines held back for the host
+    s_log.flush()
+
+
+def _record(journal, switch, phase, ok, detail=None):
+    """Journals the result of a phase for a switch, if there is a journal"""
+    if journal is not None:
+        journal.record(switch.host, phase, ok, detail)
+
 
+def _record_audit(journal, s, ok, queued):
+    """Journals the audit of a switch, with everything needed to put it back
+    on the copy or upgrade list without auditing it again. The facts are
+    left to the fact cache, so each row stays small"""
+    detail = None
+    if ok:
+        detail = {"list": queued}
+        if queued:
+            detail.update(upgradefile=s.upgradefile,
+                          image_path=s.image_path,
+                          next_version=s.next_version,
+                          upgrade_md5=s.upgrade_md5)
+    _record(journal, s, "audit", ok, detail)
 
-def check_upgrade(s, images, image_path="../images/"):
+
+def check_upgrade(s,
+                  images,
+                  image_path="../images/",
+                  collect=False,
+                  journal=None):
     """Gathers information from switch and checks it against an images file.
     Will categorise the switch as either ready for file transfer or ready for
-    upgrade. Returns both values, one will be empty"""
+    upgrade. Returns both values, one will be empty. With collect, every fact
+    not already cached is gathered up front in a single command burst"""
     status = "error"
     info = "NO INFO"
     msg = "NO MESSAGE"
     msg_color = "red"
+    queued = None
     try:
+        if collect and not s.allfacts:
+            s.collect()
         supported_switch(s)
-        s.upgradefile = images[s.family()][s.featureset()]["image"]
+        target = images.target(s)
+        s.upgradefile = target.image
         s.image_path = image_path
-        s.next_version = images[s.family()][s.featureset()]["version"]
+        s.next_version = target.version
+        s.upgrade_md5 = target.md5
         info = f"[{s.family()}][{s.featureset()}][{s.version()}]"
-        if not version.parse(s.version()) < version.parse(s.next_version):
+        if not version_key(s.version()) < target.key:
             status = "info"
             msg = "No upgrade available"
             msg_color = "white"
@@ -141,11 +409,18 @@ def check_upgrade(s, images, image_path="../images/"):
             status = "success"
             msg = f"upgrade to {s.next_version} - file already on flash"
             msg_color = "green"
-            global_arrays.upgrade_list.append(s)
+            global_arrays.upgrade_list.append(
+                HostRecord(s, global_arrays.settings))
+            queued = "upgrade"
         elif not os.path.isfile(f"{image_path}{s.upgradefile}"):
             status = "success"
             msg = f"upgrade to {s.next_version} - upgrade file not available"
             msg_color = "red"
+        elif s.upgrade_md5 and file_md5(
+                f"{image_path}{s.upgradefile}") != s.upgrade_md5:
+            status = "success"
+            msg = f"upgrade to {s.next_version} - upgrade file MD5 mismatch"
+            msg_color = "red"
         elif not int(os.stat(f"{image_path}{s.upgradefile}").st_size) < int(
                 s.free_space()):
             status = "success"
@@ -155,22 +430,31 @@ def check_upgrade(s, images, image_path="../images/"):
             status = "success"
             msg = f"upgrade to {s.next_version} - file ready for transfer"
             msg_color = "yellow"
-            global_arrays.copy_list.append(s)
+            global_arrays.copy_list.append(
+                HostRecord(s, global_arrays.settings))
+            queued = "copy"
     except SwitchNotSupported as e:
         status = "error"
         info = "Not supported"
         msg = e
         msg_color = "red"
-    except netmiko.ssh_exception.NetMikoTimeoutException:
-        status = "error"
-        info = "Unable to connect"
-        msg = "Switch timed out"
-        msg_color = "red"
     except KeyError as ke:
         status = "error"
         info = f"[{ke}]"
         msg = "Family not defined, check ../configs/swimages.yml"
         msg_color = "red"
+    except Exception as e:
+        # netmiko is only loaded by a switch that was contacted
+        from netmiko import NetMikoTimeoutException
+        if not isinstance(e, NetMikoTimeoutException):
+            raise
+        status = "error"
+        info = "Unable to connect"
+        msg = "Switch timed out"
+        msg_color = "red"
+    # Anything shown in red is looked at again when the run is resumed
+    _record_audit(journal, s, status != "error" and msg_color != "red",
+                  queued)
     print_result(
         host=s.host,
         status=status,
@@ -181,68 +465,968 @@ def check_upgrade(s, images, image_path="../images/"):
     return True
 
 
-def copy_file(log):
+async def check_upgrade_async(s,
+                              images,
+                              image_path="../images/",
+                              journal=None):
+    """Async variant of check_upgrade for an AsyncSwitch. Collects all the
+    switch facts in one session, unless they are already cached, then
+    categorises it with check_upgrade"""
+    from asyncdevices import CONNECT_ERRORS
+    try:
+        if not s.allfacts:
+            await s.gather()
+    except CONNECT_ERRORS:
+        _record_audit(journal, s, False, None)
+        print_result(
+            host=s.host,
+            status="error",
+            info="Unable to connect",
+            msg="Switch timed out",
+            msg_color="red",
+        )
+        return True
+    return check_upgrade(s, images, image_path, journal=journal)
+
+
+def _switch_failed(log, phase, record, error, journal=None):
+    """Logs and journals a switch whose phase was ended by an error. Returns
+    None, the result of a switch that could not be worked on"""
+    log.error(f"{record.host} - {phase.capitalize()} failed",
+              f"{type(error).__name__}: {error}")
+    _record(journal, record, phase, False)
+    return None
+
+
+def _per_switch(func, log, phase, journal=None):
+    """Wraps func, which works on one HostRecord, so an error talking to that
+    switch fails it in the phase instead of stopping the whole fleet"""
+
+    def run(record):
+        try:
+            return func(record)
+        except switch_errors() as e:
+            return _switch_failed(log, phase, record, e, journal)
+
+    return run
+
+
+def copy_file(log, scheduler=None, journal=None):
     """Transfers the s.upgradefile from local directory to switch flash, for a
-    list of switches. Returns a list of successful switches."""
-    for switch in global_arrays.copy_list:
+    list of switches. Returns a list of successful switches. Transfers run in
+    parallel within the limits of the scheduler. If the scheduler has an image
+    server, each switch pulls the image from it instead"""
+    scheduler = scheduler or TransferScheduler(log)
+
+    def copy(record):
+        switch = record.switch()
         log.info(f"{switch.host} - Preparing to copy file...")
-        switch.save_config()
-        switch.backup_config()
-        switch.send_config("ip scp server enable")
-        if switch.send_file(f"{switch.image_path}{switch.upgradefile}",
-                            f"flash:/{switch.upgradefile}"):
-            log.success(f"{switch.host} - Copy success")
-            global_arrays.upgrade_list.append(switch)
+        try:
+            switch.save_config()
+            switch.backup_config(phase="copy")
+            image = f"{switch.image_path}{switch.upgradefile}"
+            destination = f"flash:/{switch.upgradefile}"
+            md5 = switch.upgrade_md5 or file_md5(image)
+            server = scheduler.server
+            with scheduler.slot(switch.host):
+                progress = scheduler.progress(switch.host, throttle=not server)
+                if server:
+                    result = switch.file_landed(
+                        image, destination, md5) or switch.pull_file(
+                            server.url(switch.upgradefile),
+                            destination,
+                            progress=lambda: progress.update(
+                                os.path.getsize(image),
+                                server.sent(switch.host)),
+                            retries=scheduler.retries,
+                        )
+                else:
+                    switch.send_config("ip scp server enable")
+                    result = switch.send_file(
+                        image,
+                        destination,
+                        progress=progress.scp,
+                        retries=scheduler.retries,
+                        md5=md5,
+                        checkpoint=scheduler.checkpoint,
+                    )
+        finally:
+            switch.release()
+        _record(journal, switch, "copy", result)
+        if result:
+            log.success(f"{switch.host} - Copy success",
+                        f"{human_size(progress.rate())}/s")
         else:
             log.error(f"{switch.host} - Copy failed")
+        return result
+
+    results = scheduler.run(_per_switch(copy, log, "copy", journal),
+                            global_arrays.copy_list)
+    for record, result in zip(global_arrays.copy_list, results):
+        if result:
+            global_arrays.upgrade_list.append(record)
     return True
 
 
-def upgrade_switches(log):
+def verify_files(log, workers=1, journal=None):
+    """Checks the MD5 of the upgrade file on flash against swimages.yml, for
+    every switch in the upgrade list, several switches at a time. Switches
+    whose file does not match are removed from the upgrade list"""
+
+    def verify(record):
+        if not record.upgrade_md5:
+            return True
+        log.info(f"{record.host} - Verifying upgrade file...")
+        switch = record.switch()
+        try:
+            return switch.remote_md5(
+                f"flash:/{switch.upgradefile}") == switch.upgrade_md5
+        except switch_errors() as e:
+            # Journalled with the rest by _keep_verified
+            return _switch_failed(log, "verify", record, e)
+        finally:
+            switch.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(verify, global_arrays.upgrade_list))
+    _keep_verified(log, results, journal)
+    return True
+
+
+def _keep_verified(log, results, journal=None):
+    """Removes switches that failed verification from the upgrade list"""
+    verified = []
+    for record, result in zip(global_arrays.upgrade_list, results):
+        _record(journal, record, "verify", bool(result))
+        if result:
+            verified.append(record)
+        # None is a switch that could not be checked, logged already
+        elif result is not None:
+            log.error(f"{record.host} - Upgrade file MD5 mismatch")
+    global_arrays.upgrade_list[:] = verified
+
+
+def upgrade_switches(log, journal=None):
     """Sends an upgrade configuration to a switch, for a list of switches.
     Returns a list of successful switches"""
-    for switch in global_arrays.upgrade_list:
+
+    def upgrade(record):
+        switch = record.switch()
+        log.info(f"{switch.host} - Preparing to upgrade...")
+        try:
+            switch.save_config()
+            switch.backup_config(phase="upgrade")
+            result = switch.send_config(
+                f"boot system flash:/{switch.upgradefile}")
+        finally:
+            switch.release()
+        _record(journal, switch, "upgrade", result)
+        if result:
+            log.success(f"{switch.host} - Upgrade success")
+        else:
+            log.error(f"{switch.host} - Upgrade failed")
+        return result
+
+    upgrade = _per_switch(upgrade, log, "upgrade", journal)
+    for record in global_arrays.upgrade_list:
+        if upgrade(record):
+            global_arrays.reload_list.append(record)
+    return True
+
+
+def reload_switches(log, reloader=None, delay=5, journal=None):
+    """Sends a reload command to a switch, for a list of switches. With a
+    ReloadScheduler the switches are reloaded in waves, and every switch in
+    a wave must be back on its new version before the next wave starts"""
+    if reloader is not None:
+
+        def reload(record):
+            switch = record.switch()
+            log.info(f"{switch.host} - Preparing to reload...")
+            try:
+                switch.save_config()
+                switch.backup_config(phase="reload")
+                result = switch.reload(reloader.delay)
+                _record(journal, switch, "reload", result)
+                return result
+            finally:
+                switch.release()
+
+        _report_reloads(
+            log, reloader.run(reload, global_arrays.reload_list))
+        return True
+
+    def reload(record):
+        switch = record.switch()
+        log.info(f"{switch.host} - Preparing to reload...")
+        try:
+            switch.save_config()
+            switch.backup_config(phase="reload")
+            result = switch.reload(delay)
+        finally:
+            switch.release()
+        _record(journal, switch, "reload", result)
+        if result:
+            log.success(f"{switch.host} - Reload success, reloading in "
+                        f"{delay} mins")
+        else:
+            log.error(f"{switch.host} - Reload failed")
+        return result
+
+    reload = _per_switch(reload, log, "reload", journal)
+    for record in global_arrays.reload_list:
+        reload(record)
+    return True
+
+
+def _report_reloads(log, results):
+    """Logs the outcome of a reload run in waves"""
+    for switch, result in zip(global_arrays.reload_list, results):
+        if result:
+            log.success(f"{switch.host} - Reload success, running "
+                        f"{switch.next_version}")
+        else:
+            log.error(f"{switch.host} - Reload failed")
+
+
+def load_tiers(names, log):
+    """Reads the host lists that set the reload order. Each list is a later
+    tier than the one before"""
+    tiers = []
+    for name in names or []:
+        try:
+            with open(f"../iplists/{name}") as f:
+                tiers.append(
+                    {line.strip()
+                     for line in f.read().splitlines() if line.strip()})
+        except FileNotFoundError as e:
+            log.error(e)
+            quit()
+    return tiers
+
+
+def _stream_switches(make, hosts, cache, images, cached):
+    """Yields a switch made by make for every host, as the hosts are read.
+    hosts defaults to the host list, otherwise each host is added to it.
+    Switch facts are filled from the cache where possible, and the hosts
+    served from it are added to cached"""
+    stream = hosts is not None
+    for host in hosts if stream else list(global_arrays.host_list):
+        if stream:
+            global_arrays.host_list.append(host)
+        switch = make(host)
+        if cache is not None and cache.apply(switch, images):
+            cached.add(host)
+        yield switch
+
+
+def _resume(switch, journal):
+    """Puts a switch whose audit is in the resumed run back on the list for
+    the first phase it has not finished. Returns False if it still has to
+    be audited"""
+    state = journal.state(switch.host) if journal is not None else {}
+    ok, detail = state.get("audit", (False, None))
+    if not ok:
+        return False
+    queued = detail["list"]
+    if queued:
+        for key in ("upgradefile", "image_path", "next_version",
+                    "upgrade_md5"):
+            setattr(switch, key, detail[key])
+
+    def done(phase):
+        return state.get(phase, (False, None))[0]
+
+    step = "nothing left to do"
+    if not queued or done("reload"):
+        pass
+    elif done("upgrade"):
+        step = "reload"
+        global_arrays.reload_list.append(
+            HostRecord(switch, global_arrays.settings))
+    # A file that failed verification is copied again
+    elif queued == "copy" and not done("copy") or not state.get(
+            "verify", (True, None))[0]:
+        step = "copy"
+        global_arrays.copy_list.append(
+            HostRecord(switch, global_arrays.settings))
+    else:
+        step = "upgrade"
+        global_arrays.upgrade_list.append(
+            HostRecord(switch, global_arrays.settings))
+    print_result(
+        host=switch.host,
+        status="info",
+        info="Resumed",
+        msg=f"next step: {step}",
+        msg_color="white",
+    )
+    return True
+
+
+def _confirm_cached(switch, cache, cached):
+    """Checks a switch served from the cache is still the chassis its facts
+    were cached for, before a run changes it. If not, or it cannot tell,
+    the facts are dropped so the switch is audited afresh"""
+    serial = None
+    try:
+        serial = switch.facts().get("serial")
+    except switch_errors():
+        pass
+    if cache.confirm(switch.host, serial):
+        return True
+    cached.discard(switch.host)
+    switch.allfacts, switch.flashinfo = {}, []
+    return False
+
+
+async def _confirm_cached_async(switch, cache, cached):
+    """Async variant of _confirm_cached"""
+    from asyncdevices import CONNECT_ERRORS
+    serial = None
+    try:
+        serial = (await switch.facts()).get("serial")
+    except CONNECT_ERRORS:
+        pass
+    if cache.confirm(switch.host, serial):
+        return True
+    cached.discard(switch.host)
+    switch.allfacts, switch.flashinfo = {}, []
+    return False
+
+
+def _update_cache(switch, cache, images, cached):
+    """Stores the facts of a switch that was contacted. The entries of
+    switches in cached, served from the cache, are left as they are"""
+    if switch.host in cached:
+        cached.discard(switch.host)
+    elif cache is not None:
+        cache.store(switch, images)
+
+
+def _sort_by_host():
+    """Puts the copy and upgrade lists back into host list order"""
+    order = {host: index for index, host in enumerate(global_arrays.host_list)}
+    global_arrays.copy_list.sort(key=lambda record: order[record.host])
+    global_arrays.upgrade_list.sort(key=lambda record: order[record.host])
+
+
+def audit_hosts(user,
+                password,
+                images,
+                workers=1,
+                debug=False,
+                collect=False,
+                cache=None,
+                image_path="../images/",
+                hosts=None,
+                types=None,
+                journal=None,
+                confirm=False,
+                **options):
+    """Runs check_upgrade against every host in the host list, using a pool
+    of workers. If hosts is given, each host is checked as soon as it is
+    read from it. The copy and upgrade lists are returned in host list order
+    regardless of which switch answered first. Hosts with fresh facts in the
+    cache are not contacted, nor are hosts already audited in a resumed
+    journal run. With confirm, for a run that will change switches, a host
+    served from the cache is only asked for its serial, to check it is the
+    same chassis. types maps a host to its device type. options are passed
+    on to each Switch. A switch is only kept until its audit is done, and
+    only a few switches per worker are read ahead of the workers"""
+    types = types or {}
+    cached = set()
+    failed = []
+    ahead = threading.BoundedSemaphore(2 * max(1, workers))
+    global_arrays.settings = (s, {
+        "username": user,
+        "password": password,
+        "debug_on": debug,
+        **options
+    })
+
+    def make(host):
+        return s(host,
+                 user,
+                 password,
+                 types.get(host, "cisco_ios"),
+                 debug_on=debug,
+                 **options)
+
+    def check(sw):
+        try:
+            if confirm and sw.host in cached:
+                _confirm_cached(sw, cache, cached)
+            check_upgrade(sw, images, image_path, collect, journal)
+            _update_cache(sw, cache, images, cached)
+            return True
+        finally:
+            sw.release()
+            ahead.release()
+
+    def done(future):
+        if future.exception() is not None:
+            failed.append(future)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for sw in _stream_switches(make, hosts, cache, images, cached):
+            if _resume(sw, journal):
+                continue
+            ahead.acquire()
+            executor.submit(check, sw).add_done_callback(done)
+    # result() re-raises any unexpected exception from a worker
+    for future in failed:
+        future.result()
+    _sort_by_host()
+    return True
+
+
+async def _run_limited(func, records, workers, log, phase, journal=None):
+    """Awaits func for a switch made from every HostRecord, at most workers
+    at a time. Each switch connection is closed once its work is done. An
+    error talking to a switch fails it in the phase, and its result is None.
+    Results are returned in the same order as records"""
+    import asyncio
+
+    from asyncdevices import CONNECT_ERRORS
+    results = [None] * len(records)
+    pending = iter(enumerate(records))
+
+    async def run():
+        for index, record in pending:
+            switch = record.switch()
+            try:
+                results[index] = await func(switch)
+            except (*CONNECT_ERRORS, InvalidConfigCommand) as e:
+                _switch_failed(log, phase, record, e, journal)
+            finally:
+                await switch.close()
+
+    await asyncio.gather(*(run() for _ in range(max(1, workers))))
+    return results
+
+
+async def copy_file_async(log, workers=1, scheduler=None, journal=None):
+    """Async variant of copy_file. The scheduler site limits apply, the
+    bandwidth cap only applies to images pulled from the image server"""
+    scheduler = scheduler or TransferScheduler(log, workers)
+
+    async def copy(switch):
+        log.info(f"{switch.host} - Preparing to copy file...")
+        await switch.save_config()
+        await switch.backup_config(phase="copy")
+        image = f"{switch.image_path}{switch.upgradefile}"
+        destination = f"flash:/{switch.upgradefile}"
+        md5 = switch.upgrade_md5 or file_md5(image)
+        server = scheduler.server
+        async with scheduler.async_slot(switch.host):
+            progress = scheduler.progress(switch.host, throttle=False)
+            if server:
+                result = await switch.file_landed(
+                    image, destination, md5) or await switch.pull_file(
+                        server.url(switch.upgradefile),
+                        destination,
+                        progress=lambda: progress.update(
+                            os.path.getsize(image), server.sent(switch.host)),
+                        retries=scheduler.retries,
+                    )
+            else:
+                await switch.send_config("ip scp server enable")
+                result = await switch.send_file(
+                    image,
+                    destination,
+                    progress=progress.asyncssh,
+                    retries=scheduler.retries,
+                    md5=md5,
+                    checkpoint=scheduler.checkpoint,
+                )
+        _record(journal, switch, "copy", result)
+        if result:
+            log.success(f"{switch.host} - Copy success",
+                        f"{human_size(progress.rate())}/s")
+        else:
+            log.error(f"{switch.host} - Copy failed")
+        return result
+
+    ordered = scheduler.order(global_arrays.copy_list)
+    results = dict(
+        zip(ordered, await _run_limited(copy, ordered, workers, log, "copy",
+                                        journal)))
+    for record in global_arrays.copy_list:
+        if results[record]:
+            global_arrays.upgrade_list.append(record)
+    return True
+
+
+async def verify_files_async(log, workers=1, journal=None):
+    """Async variant of verify_files"""
+
+    async def verify(switch):
+        if not switch.upgrade_md5:
+            return True
+        log.info(f"{switch.host} - Verifying upgrade file...")
+        return await switch.remote_md5(
+            f"flash:/{switch.upgradefile}") == switch.upgrade_md5
+
+    _keep_verified(
+        log, await _run_limited(verify, global_arrays.upgrade_list, workers,
+                                log, "verify"), journal)
+    return True
+
+
+async def upgrade_switches_async(log, workers=1, journal=None):
+    """Async variant of upgrade_switches"""
+
+    async def upgrade(switch):
         log.info(f"{switch.host} - Preparing to upgrade...")
-        switch.save_config()
-        switch.backup_config()
-        if switch.send_config(f"boot system flash:/{switch.upgradefile}"):
+        await switch.save_config()
+        await switch.backup_config(phase="upgrade")
+        result = await switch.send_config(
+            f"boot system flash:/{switch.upgradefile}")
+        _record(journal, switch, "upgrade", result)
+        if result:
             log.success(f"{switch.host} - Upgrade success")
-            global_arrays.reload_list.append(switch)
         else:
             log.error(f"{switch.host} - Upgrade failed")
+        return result
+
+    results = await _run_limited(upgrade, global_arrays.upgrade_list,
+                                 workers, log, "upgrade", journal)
+    for record, result in zip(global_arrays.upgrade_list, results):
+        if result:
+            global_arrays.reload_list.append(record)
     return True
 
 
-def reload_switches(log):
-    """Sends a reload command to a switch, for a list of switches"""
-    for switch in global_arrays.reload_list:
+async def reload_switches_async(log,
+                                workers=1,
+                                reloader=None,
+                                delay=5,
+                                journal=None):
+    """Async variant of reload_switches"""
+    if reloader is not None:
+
+        async def reload_wave(record):
+            switch = record.switch()
+            log.info(f"{switch.host} - Preparing to reload...")
+            try:
+                await switch.save_config()
+                await switch.backup_config(phase="reload")
+                result = await switch.reload(reloader.delay)
+                _record(journal, switch, "reload", result)
+                return result
+            finally:
+                await switch.close()
+
+        _report_reloads(
+            log, await reloader.run_async(reload_wave,
+                                          global_arrays.reload_list))
+        return True
+
+    async def reload(switch):
         log.info(f"{switch.host} - Preparing to reload...")
-        switch.save_config()
-        switch.backup_config()
-        if switch.reload():
-            log.success(f"{switch.host} - Reload success, reloading in 5 mins")
+        await switch.save_config()
+        await switch.backup_config(phase="reload")
+        result = await switch.reload(delay)
+        _record(journal, switch, "reload", result)
+        if result:
+            log.success(f"{switch.host} - Reload success, reloading in "
+                        f"{delay} mins")
         else:
             log.error(f"{switch.host} - Reload failed")
+        return result
+
+    await _run_limited(reload, global_arrays.reload_list, workers, log,
+                       "reload", journal)
+    return True
+
+
+async def audit_hosts_async(user,
+                            password,
+                            images,
+                            workers=1,
+                            debug=False,
+                            cache=None,
+                            image_path="../images/",
+                            hosts=None,
+                            types=None,
+                            journal=None,
+                            confirm=False,
+                            **options):
+    """Async variant of audit_hosts. A single event loop drives up to workers
+    switch sessions at once, and a switch is only made once a session is
+    free for it"""
+    import asyncio
+
+    from asyncdevices import AsyncSwitch
+    types = types or {}
+    cached = set()
+    failed = []
+    tasks = set()
+    limit = asyncio.Semaphore(max(1, workers))
+    global_arrays.settings = (AsyncSwitch, {
+        "username": user,
+        "password": password,
+        "debug_on": debug,
+        **options
+    })
+
+    def make(host):
+        return AsyncSwitch(host,
+                           user,
+                           password,
+                           types.get(host, "cisco_ios"),
+                           debug_on=debug,
+                           **options)
+
+    async def check(sw):
+        try:
+            if confirm and sw.host in cached:
+                await _confirm_cached_async(sw, cache, cached)
+            await check_upgrade_async(sw, images, image_path, journal)
+            _update_cache(sw, cache, images, cached)
+            return True
+        finally:
+            await sw.close()
+            limit.release()
+
+    def done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task)
+
+    loop = asyncio.get_running_loop()
+    switches = _stream_switches(make, hosts, cache, images, cached)
+
+    async def read():
+        if hosts is None:
+            # Lets the sessions already started run while the list is read
+            await asyncio.sleep(0)
+            return next(switches, None)
+        # Reading hosts may block, such as on the pre-flight probes, so it
+        # is done off the event loop
+        return await loop.run_in_executor(None, next, switches, None)
+
+    while True:
+        sw = await read()
+        if sw is None:
+            break
+        if _resume(sw, journal):
+            continue
+        await limit.acquire()
+        task = asyncio.ensure_future(check(sw))
+        tasks.add(task)
+        task.add_done_callback(done)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # result() re-raises any unexpected exception from a session
+    for task in failed:
+        task.result()
+    _sort_by_host()
+    return True
+
+
+async def run_async(args,
+                    password,
+                    images,
+                    log,
+                    cache=None,
+                    scheduler=None,
+                    tracer=None,
+                    reloader=None,
+                    journal=None,
+                    **options):
+    """Runs every requested phase on the async engine"""
+    _set_phase(tracer, "audit")
+    await audit_hosts_async(args.user,
+                            password,
+                            images,
+                            args.workers,
+                            args.debug,
+                            cache,
+                            journal=journal,
+                            confirm=bool(args.copy or args.upgrade
+                                         or args.reload),
+                            tracer=tracer,
+                            port=args.port,
+                            **options)
+    if args.copy:
+        _set_phase(tracer, "copy")
+        await copy_file_async(log, args.workers, scheduler, journal)
+    if args.upgrade:
+        _set_phase(tracer, "verify")
+        await verify_files_async(log, args.workers, journal)
+        _set_phase(tracer, "upgrade")
+        await upgrade_switches_async(log, args.workers, journal)
+    if args.reload:
+        _set_phase(tracer, "reload")
+        await reload_switches_async(log, args.workers, reloader,
+                                    args.reload_delay, journal)
     return True
 
 
+def _set_phase(tracer, phase):
+    """Tags the events that follow with the phase, if tracing. Everything
+    logged by the phase before is written out first"""
+    logger.flush()
+    if tracer is not None:
+        tracer.phase = phase
+
+
+def run_phases(args,
+               hosts,
+               password,
+               images,
+               cache,
+               log,
+               sites=None,
+               types=None,
+               contact=None):
+    """Runs the audit and the phases asked for in args on hosts. contact is
+    the set of hosts a report needs to log in to, or None for all of them.
+    Returns the results of the run as a list of (host, phase, ok)"""
+    pool = ConnectionPool(args.max_sessions, args.idle_timeout)
+    backups = BackupStore()
+    scheduler = TransferScheduler(
+        log,
+        workers=args.workers,
+        per_site=args.site_workers,
+        prefix=args.site_prefix,
+        bandwidth=args.bandwidth * 125000,
+        retries=args.retries,
+        checkpoint=Checkpoints(),
+        names=sites,
+    )
+    if args.serve and args.copy:
+        from imageserver import ImageServer
+        scheduler.server = ImageServer(args.serve,
+                                       args.serve_port,
+                                       bandwidth=scheduler.bandwidth).start()
+    tracer = Tracer(args.trace, scheduler.site) if args.trace else None
+    journal = Journal()
+    results = []
+    wanted = {
+        "copy": args.copy,
+        "upgrade": args.upgrade,
+        "reload": args.reload,
+    }
+    phases = [phase for phase, on in wanted.items() if on]
+    if journal.start(phases, args.resume):
+        log.info(f"Resuming run {journal.run}")
+    elif args.resume:
+        log.info("No run to resume, starting a new one")
+    reloader = None
+    if args.reload_wave:
+        from reloads import ReloadScheduler
+        reloader = ReloadScheduler(
+            log,
+            wave_size=args.reload_wave,
+            per_site=args.reload_site,
+            prefix=args.site_prefix,
+            tiers=load_tiers(args.reload_last, log),
+            delay=args.reload_delay,
+            timeout=args.reload_timeout,
+            max_failures=args.reload_max_failures,
+            names=sites,
+        )
+    try:
+        # A report over a fully cached fleet opens no sessions, so it runs
+        # without loading the async engine
+        if args.engine == "async" and (contact is None or contact):
+            import asyncio
+            asyncio.run(
+                run_async(args,
+                          password,
+                          images,
+                          log,
+                          cache,
+                          scheduler,
+                          tracer,
+                          reloader,
+                          journal,
+                          backups=backups,
+                          hosts=hosts,
+                          types=types))
+        else:
+            _set_phase(tracer, "audit")
+            audit_hosts(args.user,
+                        password,
+                        images,
+                        args.workers,
+                        args.debug,
+                        args.batch,
+                        cache,
+                        hosts=hosts,
+                        types=types,
+                        journal=journal,
+                        confirm=bool(args.copy or args.upgrade
+                                     or args.reload),
+                        pool=pool,
+                        backups=backups,
+                        tracer=tracer,
+                        port=args.port)
+            if args.copy:
+                _set_phase(tracer, "copy")
+                copy_file(log, scheduler, journal)
+            if args.upgrade:
+                _set_phase(tracer, "verify")
+                verify_files(log, args.workers, journal)
+                _set_phase(tracer, "upgrade")
+                upgrade_switches(log, journal)
+            if args.reload:
+                _set_phase(tracer, "reload")
+                reload_switches(log, reloader, args.reload_delay, journal)
+        journal.finish()
+        results = journal.results()
+    finally:
+        journal.close()
+        pool.close_all()
+        if scheduler.server:
+            scheduler.server.stop()
+        if tracer is not None:
+            tracer.report(log)
+            tracer.close()
+        if args.summary:
+            logger.summary()
+    if args.copy or args.upgrade or args.reload:
+        for switch in (global_arrays.copy_list + global_arrays.upgrade_list +
+                       global_arrays.reload_list):
+            cache.discard(switch.host)
+    cache.save()
+    return results
+
+
+# Settings of a coordinator that are its own, and not sent to its workers
+_LOCAL_OPTIONS = {
+    "host", "list", "user", "worker", "coordinate", "spawn", "shard_size",
+    "shard_retries", "resume", "trace", "log_format", "log_group", "summary",
+    "debug", "serve", "serve_port"
+}
+
+
+def run_worker(args):
+    """Runs the shards handed out by a coordinator until there are none left.
+    The password is taken from SWUPGRADE_PASSWORD if set"""
+    from shards import parse_address, work
+    log = Logger("[WORKER]", debug_on=args.debug)
+    password = os.environ.get("SWUPGRADE_PASSWORD")
+    if password is None:
+        logger.flush()
+        password = getpass.getpass("Password: ")
+    images = catalog_loader("../configs/swimages.yml", log)
+
+    def run(hosts, types, sites, options):
+        shard = argparse.Namespace(**{**vars(args), **options})
+        global_arrays.clear()
+        if shard.probe_timeout:
+            hosts = preflight_hosts(hosts, shard.port, shard.probe_timeout)
+        return run_phases(shard, hosts, password, images,
+                          FactCache(ttl=shard.cache_ttl), log, sites, types)
+
+    try:
+        count = work(parse_address(args.worker), run, log)
+    except (OSError, ValueError) as e:
+        log.error(f"Coordinator {args.worker}", e)
+        return False
+    log.info(f"Ran {count} shards")
+    return True
+
+
+def _report_shards(log, shards, results, failed):
+    """Prints the outcome of every host of a sharded run, merged from the
+    results sent by the workers"""
+    failures = 0
+    for number, hosts in enumerate(shards):
+        for host in hosts:
+            phases = results.get(host, {})
+            bad = [phase for phase, ok in phases.items() if not ok]
+            if number in failed:
+                info, msg = f"Shard {number}", "Shard failed"
+            elif not phases:
+                info, msg = "Not reached", "No results from the worker"
+            elif bad:
+                info, msg = ", ".join(phases), f"Failed {', '.join(bad)}"
+            else:
+                info, msg = ", ".join(phases), "Done"
+            ok = bool(phases) and not bad and number not in failed
+            failures += not ok
+            print_result(
+                host=host,
+                status="success" if ok else "error",
+                info=info,
+                msg=msg,
+                msg_color="green" if ok else "red",
+            )
+    total = sum(len(hosts) for hosts in shards)
+    log.info(f"{total} hosts in {len(shards)} shards",
+             f"{total - failures} done, {failures} failed")
+
+
+def coordinate(args, hosts, inventory, log):
+    """Splits hosts into shards by site and hands them to workers, starting
+    args.spawn of them locally. Returns the results sent back, a dict of host
+    to a dict of phase to ok"""
+    from shards import Coordinator, parse_address, split
+    shards = split(hosts, inventory.sites, args.site_prefix, args.shard_size)
+    options = {
+        key: value
+        for key, value in vars(args).items() if key not in _LOCAL_OPTIONS
+    }
+    coordinator = Coordinator(shards, options, log,
+                              parse_address(args.coordinate),
+                              args.shard_retries, inventory.types,
+                              inventory.sites)
+    address = "%s:%d" % coordinator.address
+    log.info(f"Coordinating {len(shards)} shards on {address}")
+    commands, env = [], None
+    if args.spawn:
+        logger.flush()
+        # Handed to the local workers only, never over the socket
+        env = dict(os.environ,
+                   SWUPGRADE_PASSWORD=getpass.getpass("Password: "))
+        command = [
+            sys.executable,
+            os.path.abspath(__file__), "--worker", address, "--user",
+            args.user, "--log-format", args.log_format
+        ]
+        if args.debug:
+            command.append("--debug")
+        commands = [command] * args.spawn
+    results = coordinator.run(commands, env)
+    _set_phase(None, "report")
+    _report_shards(log, shards, results, coordinator.failed)
+    return results
+
+
 def main(args):
     """Identify if a switch has an upgrade available. Can be used to copy IOS
     file, perform config upgrade or reload a switch"""
+    logger.configure(args.log_format, args.log_group, args.summary)
     log = Logger("[MAIN]", debug_on=args.debug)
     log.debug("Executing [main]")
-    validate_hosts(args)
-    images = yaml_loader("../configs/swimages.yml", log)
-    password = getpass.getpass("Password: ")
-    for host in global_arrays.host_list:
-        sw = s(host, args.user, password, debug_on=args.debug)
-        check_upgrade(sw, images)
-    if args.copy:
-        copy_file(log)
-    if args.upgrade:
-        upgrade_switches(log)
-    if args.reload:
-        reload_switches(log)
+    if args.worker:
+        return run_worker(args)
+    inventory = Inventory(Logger(["VALIDATE HOSTS"], debug_on=args.debug))
+    hosts = validate_hosts(args, inventory)
+    if args.coordinate:
+        return coordinate(args, list(hosts), inventory, log)
+    images = catalog_loader("../configs/swimages.yml", log)
+    cache = FactCache(ttl=args.cache_ttl)
+    changes = args.copy or args.upgrade or args.reload
+    contact = None
+    if not changes and args.cache_ttl:
+        # Which hosts need a login is only known once the list is read
+        hosts = list(hosts)
+        contact = set(cache.stale(hosts, images))
+    if args.probe_timeout:
+        hosts = preflight_hosts(hosts, args.port, args.probe_timeout,
+                                contact)
+    password = None
+    # A report over a fully cached fleet never logs in
+    if contact is None or contact:
+        logger.flush()
+        password = getpass.getpass("Password: ")
+    return run_phases(args, hosts, password, images, cache, log,
+                      inventory.sites, inventory.types, contact)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+Timing instrumentation for Switch methods and remote commands. Every timed
+call is written to a JSON lines trace, and summarised per phase by command
+and by site
+"""
+
+import functools
+import inspect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Durations are counted in buckets 2% wide, so a summary takes the same
+# memory however many events a run has
+_BUCKET = math.log(1.02)
+
+
+class _Durations:
+    """Counts the durations of one group of events, for percentiles to
+    within the width of a bucket"""
+
+    __slots__ = ("count", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, duration):
+        self.count += 1
+        self.max = max(self.max, duration)
+        bucket = math.floor(math.log(max(duration, 1e-6)) / _BUCKET)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        """Returns the nearest rank percentile, as the top of its bucket"""
+        rank = min(self.count,
+                   max(1, int(round(percent / 100.0 * self.count + 0.5))))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(math.exp((bucket + 1) * _BUCKET), self.max)
+        return self.max
+
+
+class Tracer:
+    """Collects timed events. phase is set by the caller as the run moves
+    through audit, copy, upgrade and reload. site maps a host to its site. If
+    path is given, events are written to it as JSON lines. Only the
+    summary is kept in memory"""
+
+    def __init__(self, path=None, site=None):
+        self.path = path
+        self.site = site or (lambda host: host)
+        self.phase = None
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.sites = {}
+        self.file = open(path, "w") if path else None
+
+    def record(self, host, name, kind, start, duration, **extra):
+        """Adds a finished event"""
+        event = {
+            "host": host,
+            "site": self.site(host) if host else None,
+            "phase": self.phase,
+            "kind": kind,
+            "name": name,
+            "start": start,
+            "duration": duration,
+            **extra,
+        }
+        label = f"{kind} {name}"
+        with self.lock:
+            self.commands.setdefault((self.phase, label),
+                                     _Durations()).add(duration)
+            if kind == "command":
+                self.sites.setdefault((self.phase, f"site {event['site']}"),
+                                      _Durations()).add(duration)
+            if self.file:
+                self.file.write(json.dumps(event) + "\n")
+        return event
+
+    @contextmanager
+    def span(self, host, name, kind="method"):
+        """Times the enclosed block. Extra fields can be set on the yielded
+        dict, such as bytes for a transfer"""
+        extra = {}
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            self.record(host, name, kind, start,
+                        time.perf_counter() - began, **extra)
+
+    def summary(self):
+        """Returns the p50, p95 and max duration per phase and call, and of
+        remote commands per phase and site, as two dicts keyed by tuple.
+        Calls are labelled with their kind, such as method or command"""
+        with self.lock:
+            return _stats(self.commands), _stats(self.sites)
+
+    def report(self, log):
+        """Logs the summary tables"""
+        for table in self.summary():
+            for (phase, name), stats in sorted(table.items(),
+                                               key=lambda i: str(i[0])):
+                log.info(
+                    f"[{phase}] {name}",
+                    f"n={stats['count']} p50={stats['p50']:.3f}s "
+                    f"p95={stats['p95']:.3f}s max={stats['max']:.3f}s",
+                )
+        return True
+
+    def close(self):
+        """Closes the trace file"""
+        if self.file:
+            self.file.close()
+            self.file = None
+        return True
+
+
+def _stats(groups):
+    return {
+        key: {
+            "count": durations.count,
+            "p50": durations.percentile(50),
+            "p95": durations.percentile(95),
+            "max": durations.max,
+        }
+        for key, durations in groups.items()
+    }
+
+
+def timed(method):
+    """Records a span for every call of a Switch method when the switch has
+    a tracer. Works for plain and async methods"""
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            if self.tracer is None:
+                return await method(self, *args, **kwargs)
+            with self.tracer.span(self.host, method.__name__):
+                return await method(self, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return method(self, *args, **kwargs)
+        with self.tracer.span(self.host, method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class TracedConnection:
+    """Wraps a netmiko connection so every remote command is timed"""
+
+    _commands = ("send_command", "send_command_timing", "send_config_set",
+                 "find_prompt", "read_until_pattern")
+
+    def __init__(self, connect, tracer, host):
+        self._connect = connect
+        self._tracer = tracer
+        self._host = host
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connect, name)
+        if name not in self._commands:
+            return attribute
+
+        @functools.wraps(attribute)
+        def command(*args, **kwargs):
+            label = name
+            if args and isinstance(args[0], str) and name.startswith(
+                    "send_command"):
+                label = args[0]
+            with self._tracer.span(self._host, label, "command"):
+                return attribute(*args, **kwargs)
+
+        return command
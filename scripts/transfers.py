@@ -0,0 +1,263 @@
+"""
+!/usr/bin/env python3
+
+LiamJordan. For support: lsjordan.uk@gmail.com
+A scheduler for image transfers to many switches at once. Limits the number
+of transfers per site, caps the total bandwidth used and reports progress
+per host
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from itertools import zip_longest
+
+from inventory import site_of
+
+try:
+    import fcntl
+except ImportError:
+    # Windows locks a file with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+
+def human_size(count):
+    """Formats a number of bytes for display"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if count < 1024 or unit == "GB":
+            return f"{count:.1f} {unit}"
+        count /= 1024
+
+
+# MD5 hashes of local files, keyed by path, size and mtime
+_hashes = {}
+_hash_lock = threading.Lock()
+
+
+def file_md5(path):
+    """Returns the MD5 hash of a local file. The file is memory mapped and
+    hashed once, then served from memory until its size or mtime change"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if key not in _hashes:
+            md5 = hashlib.md5()
+            if stat.st_size:
+                with open(path, "rb") as image, mmap.mmap(
+                        image.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    md5.update(data)
+            _hashes[key] = md5.hexdigest()
+        return _hashes[key]
+
+
+@contextmanager
+def _file_lock(path):
+    """Holds an exclusive lock on path, shared by every process on the host,
+    for the enclosed block"""
+    with open(path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        else:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class Checkpoints:
+    """Records the outcome of every transfer attempt, and how many bytes it
+    sent, in a JSON file. Workers may share the file, so it is read again
+    and only the host recorded is changed, under a lock"""
+
+    def __init__(self, path="../cache/transfers.json"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as checkpoints:
+                return json.load(checkpoints)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def record(self, host, file, sent, status):
+        """Records a transfer attempt and writes the file"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock, _file_lock(f"{self.path}.lock"):
+            self.entries = self._read()
+            entry = self.entries.get(host, {})
+            attempts = entry.get("attempts", 0) if entry.get(
+                "file") == file else 0
+            self.entries[host] = {
+                "file": file,
+                "sent": sent,
+                "status": status,
+                "attempts": attempts + 1,
+                "time": time.time(),
+            }
+            temp = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp, "w") as checkpoints:
+                json.dump(self.entries, checkpoints)
+            os.replace(temp, self.path)
+        return True
+
+
+class _Bandwidth:
+    """Paces every transfer so their combined rate stays under a cap, given
+    in bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def consume(self, count):
+        """Blocks until count bytes may be sent"""
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + count / self.rate
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _Progress:
+    """Tracks a single transfer and logs its throughput and ETA"""
+
+    def __init__(self, host, log, bandwidth=None, interval=10):
+        self.host = host
+        self.log = log
+        self.bandwidth = bandwidth
+        self.interval = interval
+        self.start = time.monotonic()
+        self.reported = self.start
+        self.sent = 0
+
+    def rate(self):
+        """Returns the average transfer rate in bytes per second"""
+        return self.sent / max(time.monotonic() - self.start, 0.001)
+
+    def update(self, size, sent):
+        """Records the bytes sent so far, throttling if a cap is set"""
+        if self.bandwidth is not None and sent > self.sent:
+            self.bandwidth.consume(sent - self.sent)
+        self.sent = sent
+        now = time.monotonic()
+        if now - self.reported < self.interval or sent >= size:
+            return
+        self.reported = now
+        rate = self.rate()
+        eta = int((size - sent) / rate) if rate else 0
+        self.log.info(
+            f"{self.host} - Copying {human_size(sent)} of {human_size(size)}",
+            f"{round(100.0 * sent / size, 1)}% at {human_size(rate)}/s, "
+            f"ETA {eta // 60}m{eta % 60:02d}s",
+        )
+
+    def scp(self, filename, size, sent):
+        """Progress callback for SCPClient"""
+        self.update(size, sent)
+
+    def asyncssh(self, srcpath, dstpath, copied, total):
+        """Progress handler for asyncssh.scp"""
+        self.update(total, copied)
+
+
+class TransferScheduler:
+    """Runs transfers with at most workers in flight overall and per_site in
+    flight for any one site. A site is the subnet of the switch address with
+    the given prefix length, unless names gives the host a named site.
+    bandwidth caps the total rate in bytes per second. Dropped transfers are
+    retried up to retries times. When server is set to an ImageServer,
+    switches pull images from it"""
+
+    def __init__(self,
+                 log,
+                 workers=1,
+                 per_site=0,
+                 prefix=24,
+                 bandwidth=0,
+                 interval=10,
+                 retries=0,
+                 checkpoint=None,
+                 names=None):
+        self.log = log
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.server = None
+        self.workers = max(1, workers)
+        self.per_site = per_site
+        self.prefix = prefix
+        self.names = {} if names is None else names
+        self.bandwidth = _Bandwidth(bandwidth) if bandwidth else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def site(self, host):
+        """Returns the site a host belongs to"""
+        return site_of(host, self.prefix, self.names)
+
+    def order(self, switches):
+        """Interleaves switches across sites, so a busy site does not hold up
+        workers that could be copying to another one"""
+        sites = {}
+        for switch in switches:
+            sites.setdefault(self.site(switch.host), []).append(switch)
+        return [
+            switch for group in zip_longest(*sites.values())
+            for switch in group if switch is not None
+        ]
+
+    def _limit(self, host, factory):
+        with self.lock:
+            site = self.site(host)
+            if site not in self.sites:
+                self.sites[site] = factory(self.per_site)
+            return self.sites[site]
+
+    @contextmanager
+    def slot(self, host):
+        """Holds a transfer slot for the host's site"""
+        if not self.per_site:
+            yield
+            return
+        with self._limit(host, threading.Semaphore):
+            yield
+
+    @asynccontextmanager
+    async def async_slot(self, host):
+        """Holds a transfer slot for the host's site on the event loop"""
+        import asyncio
+        if not self.per_site:
+            yield
+            return
+        async with self._limit(host, asyncio.Semaphore):
+            yield
+
+    def progress(self, host, throttle=True):
+        """Returns a progress tracker for a transfer to host. Trackers used on
+        the event loop must not throttle, as that would block the loop"""
+        return _Progress(host, self.log,
+                         self.bandwidth if throttle else None, self.interval)
+
+    def run(self, func, switches):
+        """Calls func for every switch on a pool of workers. Returns the
+        results in the same order as switches"""
+        ordered = self.order(switches)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = dict(zip(ordered, pool.map(func, ordered)))
+        return [results[switch] for switch in switches]